@@ -1,14 +1,17 @@
-import copy
+import abc
 
-from mesa import Model, Agent
+from mesa import Agent
+import numpy as np
 import torch
-import tracemalloc
 
 device = torch.device("cuda:0")
 
 
-class NeuralAgent(Agent):
+class NeuralAgent(Agent, metaclass=abc.ABCMeta):
     """ An agent with fixed initial wealth."""
+    # Offsets (dx, dy) of the cells an agent senses, and what an empty, occupied and out of bounds cell reads as
+    SENSORS = []
+    SENSOR_VALUES = (1, 0, 2)
 
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
@@ -26,14 +29,7 @@ class NeuralAgent(Agent):
             self.choose_action()
 
     def choose_action(self):
-        inputs = self.get_inputs()
-
-        for i in range(int(len(self.weights) / 2)):
-            self.model.net[2 * i].weight = torch.nn.Parameter(self.weights[2 * i])
-            self.model.net[2 * i].bias = torch.nn.Parameter(self.weights[(2 * i) + 1])
-
-        with torch.no_grad():
-            outputs = self.model.net(torch.tensor(inputs, dtype=torch.float))
+        outputs = self.model.get_outputs(self)
 
         im_neighborhood = self.generate_neighborhood_pad()
 
@@ -45,6 +41,26 @@ class NeuralAgent(Agent):
         else:
             self.model.grid.move_agent(self, self.pos)
 
+    def get_inputs(self):
+        return self.batch_inputs(self.model, [self])[0]
+
+    @classmethod
+    @abc.abstractmethod
+    def batch_inputs(cls, model, agents):
+        """
+        The net inputs of many agents of this class at once, read from the model grid's occupancy array. Every kind
+        of neural agent defines its own, so NeuralAgent itself cannot be instantiated.
+        :return: (agents, n_inputs) float32 array
+        """
+
+    @property
+    def weights(self):
+        """
+        This agent's row of the model's genomes, as a tensor per net parameter.
+        """
+        slot = self.unique_id - self.model.vis_agents
+        return [weight[slot] for weight in self.model.layer_weights]
+
     def die(self):
         self.model.grid.move_to_empty(self)
 
@@ -85,21 +101,18 @@ class NeuralAgent(Agent):
         return neighborhood
 
 class ComplexNeuralAgent(NeuralAgent):
+    # Four cells either way along the row and then along the column
+    SENSORS = [(dx, 0) for dx in range(-4, 5) if dx] + [(0, dy) for dy in range(-4, 5) if dy]
+
     def __init__(self, model, pos):
         super().__init__(model, pos)
-        self.weights = [torch.randn_like(self.model.net[0].weight), torch.randn_like(self.model.net[0].bias),
-                        torch.randn_like(self.model.net[2].weight), torch.randn_like(self.model.net[2].bias)]
-        self.model.weights.append(self.weights)
 
-    def get_inputs(self):
-        neighbours = [(x, self.pos[1]) for x in range(self.pos[0] - 4, self.pos[0] + 5)] + [(self.pos[0], y) for y in
-                                                                                            range(self.pos[1] - 4,
-                                                                                                  self.pos[1] + 5)]
-        neighbours.remove(self.pos)
-        neighbours.remove(self.pos)
-        return [self.model.age, self.model.colour] + [self.model.grid.is_cell_empty(pos) if (
-                0 <= pos[0] < self.model.grid.width and 0 <= pos[1] < self.model.grid.height) else 2 for pos in
-                                                      neighbours] + list(self.pos)
+    @classmethod
+    def batch_inputs(cls, model, agents):
+        positions = positions_of(agents)
+        return np.column_stack([np.full(len(agents), model.age), np.full(len(agents), model.colour),
+                                model.grid.sense(positions, cls.SENSORS, cls.SENSOR_VALUES),
+                                positions]).astype(np.float32)
 
 
 class SimpleNeuralAgent(NeuralAgent):
@@ -107,56 +120,63 @@ class SimpleNeuralAgent(NeuralAgent):
         super().__init__(model, pos)
         self.colour = "Black"
         self.type = "Simple"
-        self.weights = [torch.randn_like(self.model.net[0].weight), torch.randn_like(self.model.net[0].bias)]
-        self.model.weights.append(self.weights)
 
-    def get_inputs(self):
-        return [self.model.age / self.model.max_age] + [self.pos[0] / (self.model.grid.width - 1),
-                                                        self.pos[1] / (self.model.grid.height - 1)]
+    @classmethod
+    def batch_inputs(cls, model, agents):
+        return np.column_stack([np.full(len(agents), model.age / model.max_age),
+                                positions_of(agents) / scale_of(model)]).astype(np.float32)
 
 
 class RaceNeuralAgent(NeuralAgent):
+    # The four neighbours, a side off the edge of the grid reading 1
+    SENSORS = [(-1, 0), (0, -1), (0, 1), (1, 0)]
+    SENSOR_VALUES = (2 / 3, 1 / 3, 1)
+
     def __init__(self, model, pos):
         super().__init__(model, pos)
-        self.weights = [torch.randn_like(self.model.net[0].weight), torch.randn_like(self.model.net[0].bias)]
         self.colour = self.random.randint(0, 1)
         self.type = "Race"
-        self.model.weights.append(self.weights)
 
-    def get_inputs(self):
-        ate_neighborhood = self.generate_neighborhood_pad()
-        ate_neighborhood.pop(2)
-        for idx, x in enumerate(ate_neighborhood):
-            if x == self.pos:
-                ate_neighborhood[idx] = 1
-            elif self.model.grid.is_cell_empty(x):
-                ate_neighborhood[idx] = 2/3
-            else:
-                ate_neighborhood[idx] = 1/3
-        return [self.model.age / self.model.max_age, 0.7 if (self.colour == 1) else 0.3] + [
-            self.pos[0] / (self.model.grid.width - 1), self.pos[1] / (self.model.grid.height - 1)] + ate_neighborhood
+    @classmethod
+    def batch_inputs(cls, model, agents):
+        positions = positions_of(agents)
+        colours = np.array([agent.colour for agent in agents])
+        return np.column_stack([np.full(len(agents), model.age / model.max_age), np.where(colours == 1, 0.7, 0.3),
+                                positions / scale_of(model),
+                                model.grid.sense(positions, cls.SENSORS, cls.SENSOR_VALUES)]).astype(np.float32)
 
 
 class FourRaceNeuralAgent(NeuralAgent):
+    # The four neighbours, a side off the edge of the grid reading 1
+    SENSORS = [(-1, 0), (0, -1), (0, 1), (1, 0)]
+    SENSOR_VALUES = (2 / 3, 1 / 3, 1)
+
     def __init__(self, model, pos):
         super().__init__(model, pos)
-        self.weights = [torch.randn_like(self.model.net[0].weight), torch.randn_like(self.model.net[0].bias),torch.randn_like(self.model.net[2].weight), torch.randn_like(self.model.net[2].bias)]
         self.colour = self.random.randint(0, 3)
         self.type = "Race"
-        self.model.weights.append(self.weights)
 
-    def get_inputs(self):
-        ate_neighborhood = self.generate_neighborhood_pad()
-        ate_neighborhood.pop(2)
-        for idx, x in enumerate(ate_neighborhood):
-            if x == self.pos:
-                ate_neighborhood[idx] = 1
-            elif self.model.grid.is_cell_empty(x):
-                ate_neighborhood[idx] = 2/3
-            else:
-                ate_neighborhood[idx] = 1/3
-        return [self.model.age / self.model.max_age, (self.colour + 1)/4] + [
-            self.pos[0] / (self.model.grid.width - 1), self.pos[1] / (self.model.grid.height - 1)] + ate_neighborhood
+    @classmethod
+    def batch_inputs(cls, model, agents):
+        positions = positions_of(agents)
+        colours = np.array([agent.colour for agent in agents])
+        return np.column_stack([np.full(len(agents), model.age / model.max_age), (colours + 1) / 4,
+                                positions / scale_of(model),
+                                model.grid.sense(positions, cls.SENSORS, cls.SENSOR_VALUES)]).astype(np.float32)
+
+
+def positions_of(agents):
+    """
+    :return: (agents, 2) array of the agents' cells
+    """
+    return np.array([agent.pos for agent in agents], dtype=np.int64).reshape(-1, 2)
+
+
+def scale_of(model):
+    """
+    :return: what positions are divided by to normalise them to [0, 1]
+    """
+    return np.array([model.grid.width - 1, model.grid.height - 1])
 
 
 class GridColour(Agent):
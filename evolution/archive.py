@@ -0,0 +1,124 @@
+import json
+import os
+
+import numpy as np
+
+ARCHIVE_VERSION = 1
+# Column files of an archive and their dtypes
+COLUMNS = {"genomes": np.float32, "parents": np.int32, "fitness": np.float32}
+
+
+class GenomeArchive:
+    """
+    Append-only record of every generation of a run: the genomes (generations, n_agents, n_params), the slots of each
+    agent's two parents in the generation before (generations, n_agents, 2), -1 for the first generation, and each
+    agent's fitness (generations, n_agents).
+
+    Each column is a raw file in directory that a generation is appended to, described by meta.json. Reading
+    memory-maps the files, so any slice across thousands of generations can be taken without loading the rest. A
+    generation only counts once it is in every column, so an append cut short is ignored.
+    """
+
+    def __init__(self, directory, n_agents, n_params):
+        self.directory = directory
+        self.shapes = {"genomes": (n_agents, n_params), "parents": (n_agents, 2), "fitness": (n_agents,)}
+        meta = {"version": ARCHIVE_VERSION, "n_agents": n_agents, "n_params": n_params}
+        path = os.path.join(directory, "meta.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                existing = json.load(f)
+            if existing != meta:
+                raise ValueError(f"{directory} holds an archive of {existing}, not {meta}")
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(meta, f)
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(directory, meta["n_agents"], meta["n_params"])
+
+    def path(self, column):
+        return os.path.join(self.directory, column + ".bin")
+
+    def row_bytes(self, column):
+        return int(np.prod(self.shapes[column])) * np.dtype(COLUMNS[column]).itemsize
+
+    def __len__(self):
+        return min((os.path.getsize(self.path(column)) if os.path.exists(self.path(column)) else 0)
+                   // self.row_bytes(column) for column in COLUMNS)
+
+    def append(self, genomes, parents, fitness):
+        """
+        Add a generation to the end of the archive.
+        """
+        for column, values in [("genomes", genomes), ("parents", parents), ("fitness", fitness)]:
+            values = np.ascontiguousarray(values, dtype=COLUMNS[column])
+            if values.shape != self.shapes[column]:
+                raise ValueError(f"Expected {column} of shape {self.shapes[column]}, not {values.shape}")
+            with open(self.path(column), "ab") as f:
+                f.write(values.tobytes())
+
+    def truncate(self, generations):
+        """
+        Drop every generation from generations on, as when a run is resumed from an earlier snapshot.
+        """
+        for column in COLUMNS:
+            if os.path.exists(self.path(column)):
+                os.truncate(self.path(column), min(generations * self.row_bytes(column),
+                                                   os.path.getsize(self.path(column))))
+
+    def column(self, column):
+        """
+        :return: read-only memory map of a whole column, a row per generation
+        """
+        generations = len(self)
+        if generations == 0:
+            return np.zeros((0,) + self.shapes[column], dtype=COLUMNS[column])
+        return np.memmap(self.path(column), dtype=COLUMNS[column], mode="r",
+                         shape=(generations,) + self.shapes[column])
+
+    @property
+    def genomes(self):
+        return self.column("genomes")
+
+    @property
+    def parents(self):
+        return self.column("parents")
+
+    @property
+    def fitness(self):
+        return self.column("fitness")
+
+
+def lineage(archive, generation, agent):
+    """
+    Follow an agent's first parents back to the first generation.
+    :return: the agent's slot in every generation from the first to generation
+    """
+    parents = archive.parents
+    slots = [agent]
+    for g in range(generation, 0, -1):
+        slots.append(int(parents[g, slots[-1], 0]))
+    return np.array(slots[::-1])
+
+
+def diversity(archive, chunk=256):
+    """
+    :return: mean over the parameters of the population's standard deviation, per generation
+    """
+    genomes = archive.genomes
+    return np.concatenate([genomes[start:start + chunk].std(axis=1).mean(axis=1)
+                           for start in range(0, len(genomes), chunk)] or [np.zeros(0)])
+
+
+def drift(archive, chunk=256):
+    """
+    :return: distance the population's mean genome moved from each generation to the next
+    """
+    genomes = archive.genomes
+    means = np.concatenate([genomes[start:start + chunk].mean(axis=1) for start in range(0, len(genomes), chunk)]
+                           or [np.zeros((0, genomes.shape[2]))])
+    return np.linalg.norm(np.diff(means, axis=0), axis=1)
@@ -1,24 +1,29 @@
 from models import *
+from snapshots import latest_snapshot
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-import tracemalloc
-load = True
 if __name__ == "__main__":
-    model = FourRaceClassificationModel(n=100, width=35, height=35, mutation_rate=0.1, max_age=200)
-    model.save_iterator = 100
+    save_path = "saved_models/four_race_deep/race_evolution_"
     graph_iterator = 50
     num_gens = 10_000
-    start_gen = 0
-    if load:
-        model = pickle.load(open("saved_models/four_race_deep/race_evolution_700.pkl", "rb"))
-        start_gen = 700
+    # Carry on from the run's latest snapshot if it has one
+    latest = latest_snapshot(save_path)
+    if latest is None:
+        model = FourRaceClassificationModel(n=100, width=35, height=35, mutation_rate=0.1, max_age=200,
+                                            save_path=save_path)
+        model.save_iterator = 100
+    else:
+        model = load_snapshot(latest)
         #model.mutation_rate = 0.001
+    start_gen = model.steps // model.max_age
+    model.record_lineage("saved_models/four_race_deep/lineage")
     for j in tqdm(range(start_gen, num_gens)):
         for i in range(model.max_age):
             model.step()
         if j % graph_iterator == 0:
             plt.plot(model.datacollector.get_model_vars_dataframe()["Correct"])
             plt.show()
+    model.flush_checkpoints()
     # for stat in model.snap.statistics('lineno')[:20]:
     #     print(stat)
     plt.plot(model.datacollector.get_model_vars_dataframe()["Correct"])
@@ -0,0 +1,63 @@
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from models import *
+
+
+def run(job):
+    """
+    Evolve one model for some generations under one activation mode.
+    :return: the activation, the seed, the Correct percentage of every generation and the seconds per generation
+    """
+    model_class, activation, seed, generations, params = job
+    model = model_class(**params, seed=seed, activation=activation)
+    # No checkpoints
+    model.save_iterator = generations + 1
+    start = time.perf_counter()
+    for _ in range(generations * model.max_age):
+        model.step()
+    elapsed = time.perf_counter() - start
+    return activation, seed, model.datacollector.model_vars["Correct"], elapsed / generations
+
+
+def compare_activations(model_class, generations, seeds, processes=None, activations=("sequential", "simultaneous"),
+                        **params):
+    """
+    Evolve model_class under each of activations, once per seed for each, on a process pool. Every mode gets the
+    same seeds, so they start from the same genomes. The default compares simultaneous activation with the exact
+    one-at-a-time sequential activation, where every agent sees the moves made before its turn; add "planned" to
+    also run sequential moves chosen from the start of the tick.
+    :return: frame of the Correct percentage by generation, activation and seed, and the mean seconds per generation
+    of each activation
+    """
+    jobs = [(model_class, activation, seed, generations, params) for activation in activations for seed in seeds]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(run, jobs)
+    curves = pd.DataFrame({(activation, seed): correct for activation, seed, correct, _ in results})
+    curves.columns.names = ["Activation", "Seed"]
+    curves.index.name = "Generation"
+    timings = {activation: np.mean([elapsed for mode, _, _, elapsed in results if mode == activation])
+               for activation in activations}
+    return curves, timings
+
+
+if __name__ == "__main__":
+    generations = 200
+    curves, timings = compare_activations(FourRaceClassificationModel, generations, seeds=range(4), n=100, width=35,
+                                          height=35, mutation_rate=0.1, max_age=200)
+    curves.to_csv("activation_comparison.csv")
+    for activation in timings:
+        runs = curves[activation]
+        print(f"{activation}: {timings[activation]:.2f}s per generation, "
+              f"final Correct {runs.iloc[-1].mean():.1f}% +/- {runs.iloc[-1].std():.1f}")
+        plt.plot(runs.mean(axis=1), label=activation)
+        plt.fill_between(runs.index, runs.min(axis=1), runs.max(axis=1), alpha=0.3)
+    plt.xlabel("Generation")
+    plt.ylabel("Correct (%)")
+    plt.legend(loc="lower right")
+    plt.savefig("activation_comparison.png")
+    plt.show()
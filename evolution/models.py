@@ -1,24 +1,37 @@
-import pickle
 import random
 import matplotlib
-from mesa.space import MultiGrid, Grid, SingleGrid
 from mesa.datacollection import DataCollector
 from mesa.time import RandomActivation
+from mesa import Model
 import numpy as np
-import copy
 from agents import *
-import tracemalloc
+from archive import GenomeArchive
+from occupancy import EMPTY, OccupancyGrid
+from snapshots import BackgroundWriter, read_snapshot, save_snapshot
+
+
+# sequential: agents look and move one at a time in a random order, as mesa's RandomActivation runs them. planned:
+# the same order, but every agent chooses from what it saw at the start of the tick. simultaneous: every agent moves
+# at once, see EvolutionModel.move_simultaneously
+ACTIVATIONS = ["sequential", "planned", "simultaneous"]
+# Where each of the first five net outputs moves an agent, in the order of NeuralAgent.generate_neighborhood_pad
+MOVES = np.array([(-1, 0), (0, -1), (0, 0), (0, 1), (1, 0)])
 
 
 class EvolutionModel(Model):
     """A model with some number of agents."""
 
-    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_"):
+    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_",
+                 seed=None, activation="sequential"):
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"activation must be one of {', '.join(ACTIVATIONS)}, not {activation}")
+        self.activation = activation
         self.snap = None
         self.num_agents = n
         #tracemalloc.start()
         self.n = n
-        self.grid = SingleGrid(width, height, False)
+        self.grid = OccupancyGrid(width, height, False,
+                                  pad=max([max(abs(dx), abs(dy)) for dx, dy in self.agent.SENSORS], default=0))
         self.schedule = RandomActivation(self)
         self.running = True
         #self.snap = None
@@ -28,14 +41,23 @@ class EvolutionModel(Model):
         self.steps = 0
         self.max_age = max_age
         self.correct = 0
-        self.weights = []
         self.count = 0
         self.winners = []
+        self.rng = np.random.default_rng(seed)
+        self.layout = genome_layout(self.net)
+        self.n_params = sum(int(np.prod(shape)) for _, shape in self.layout)
+        # One row of parameters per neural agent, in the order the agents are added to the schedule
+        self.genomes = self.rng.standard_normal((n, self.n_params), dtype=np.float32)
+        # Each agent's two parents' slots in the generation before, -1 in the first generation
+        self.parents = np.full((n, 2), -1, dtype=np.int32)
         self.vis_agents = self.generate_visual_agents()
         self.generate_agents(self.agent)
+        self.stack_weights()
         self.datacollector = DataCollector(
             model_reporters={"Correct": correct_count})
         self.save_file_path = save_path
+        self.writer = None
+        self.archive = None
         # self.generate_agent_colours_from_gene_pool()
         for layer in self.net:
             for param in layer.parameters():
@@ -45,29 +67,168 @@ class EvolutionModel(Model):
         self.steps += 1
         self.age += 1
         self.snap = None
-        if (self.steps // self.max_age) % self.save_iterator == 0:
-            with open(self.save_file_path + str(self.steps // self.max_age) + ".pkl", "wb") as f:
-                pickle.dump(self, f)
         if self.age == self.max_age:
             #self.snap = tracemalloc.take_snapshot()
-            self.weights = []
             self.correct = correct_amount(self)
             self.datacollector.collect(self)
-            self.num_agents = 0
             self.schedule.step()
+            if self.archive is not None:
+                self.archive_generation()
             self.sexual_reproduction()
             self.age = 0
             # self.generate_agent_colours_from_gene_pool()
-            for idx, weight in enumerate(self.weights):
-                if idx < (len(self.schedule.agents) - self.vis_agents):
-                    self.schedule.agents[idx + self.vis_agents].weights = weight
-            if self.num_agents < self.n:
-                for i in range(self.num_agents, self.n):
-                    self.num_agents += 1
-                    self.schedule.agents[i + self.vis_agents].weights = random.choice(self.weights)
+            self.stack_weights()
+            if (self.steps // self.max_age) % self.save_iterator == 0:
+                self.checkpoint()
+        elif self.activation == "simultaneous":
+            self.move_simultaneously()
         else:
+            self.plan_actions()
             self.schedule.step()
 
+    def move_simultaneously(self):
+        """
+        A tick in which every neural agent chooses its move from the same snapshot of the grid. A move succeeds if
+        its target cell was empty at the start of the tick; when several agents go for the same cell, the one with
+        the highest random priority, drawn afresh each tick, gets it and the others stay where they are. Cells
+        vacated during the tick only become free on the next one.
+        :return:
+        """
+        agents = self.schedule.agents[self.vis_agents:]
+        positions = positions_of(agents)
+        moves = np.asarray(torch.argmax(self.forward(torch.from_numpy(self.agent.batch_inputs(self, agents))), dim=1))
+        # The last output moves to a random one of the other five
+        choice = np.where(moves == len(MOVES), self.rng.integers(0, len(MOVES), len(agents)), moves)
+        targets = positions + MOVES[choice]
+        inside = ((targets >= 0) & (targets < [self.grid.width, self.grid.height])).all(axis=1)
+        targets[~inside] = positions[~inside]
+        pad = self.grid.pad
+        movers = np.flatnonzero(self.grid.occupancy[targets[:, 0] + pad, targets[:, 1] + pad] == EMPTY)
+        priority = self.rng.permutation(len(agents))[movers]
+        cells = targets[movers, 0] * self.grid.height + targets[movers, 1]
+        order = np.lexsort((-priority, cells))
+        _, first = np.unique(cells[order], return_index=True)
+        for idx in movers[order[first]]:
+            self.grid.move_agent(agents[idx], tuple(targets[idx].tolist()))
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+    def record_lineage(self, directory):
+        """
+        Append every generation from now on to the GenomeArchive in directory. If the archive already goes past
+        this model's generation, as when resuming from an earlier snapshot, the generations after it are dropped.
+        :return: the archive
+        """
+        self.archive = GenomeArchive(directory, self.n, self.n_params)
+        self.archive.truncate(self.steps // self.max_age)
+        if len(self.archive) != self.steps // self.max_age:
+            raise ValueError(f"The archive in {directory} stops at generation {len(self.archive)}, before this "
+                             f"model's generation {self.steps // self.max_age}")
+        return self.archive
+
+    def archive_generation(self):
+        """
+        Queue the generation that has just finished, with its parents and which of its agents were correct, to be
+        appended to the archive in the background.
+        :return:
+        """
+        fitness = np.zeros(self.n, dtype=np.float32)
+        fitness[[agent.unique_id - self.vis_agents for agent in self.winners]] = 1
+        self.background_writer().submit(self.archive.append, self.genomes, self.parents, fitness)
+
+    def background_writer(self):
+        if self.writer is None:
+            self.writer = BackgroundWriter()
+        return self.writer
+
+    def checkpoint(self):
+        """
+        Snapshot the model at a generation boundary to save_path + generation + ".npz", written in the background.
+        :return:
+        """
+        meta, arrays = self.snapshot()
+        path = f"{self.save_file_path}{self.steps // self.max_age}.npz"
+        self.background_writer().submit(save_snapshot, path, meta, arrays)
+
+    def flush_checkpoints(self):
+        """
+        Wait for the checkpoints and archived generations still being written.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def snapshot(self):
+        """
+        What it takes to carry on from a generation boundary: the genomes and their parents, where the agents start
+        and their colours, the RNG states, the step counter and the Correct history. Everything else is rebuilt from
+        the parameters.
+        :return: a JSON-able meta dict and a dict of arrays
+        """
+        agents = self.schedule.agents[self.vis_agents:]
+        meta = {"model": type(self).__name__, "save_path": self.save_file_path, "save_iterator": self.save_iterator,
+                "params": {"n": self.n, "width": self.grid.width, "height": self.grid.height, "max_age": self.max_age,
+                           "mutation_rate": self.mutation_rate, "activation": self.activation},
+                "steps": self.steps, "count": self.count, "correct": self.correct, "rng": self.rng.bit_generator.state,
+                "random": self.random.getstate(), "global_random": random.getstate()}
+        arrays = {"genomes": self.genomes.copy(), "parents": self.parents.copy(),
+                  "positions": positions_of(agents),
+                  "history": np.array(self.datacollector.model_vars["Correct"], dtype=np.float64)}
+        if hasattr(agents[0], "colour"):
+            arrays["colours"] = np.array([agent.colour for agent in agents])
+        return meta, arrays
+
+    def stack_weights(self):
+        """
+        Unpack the genomes into a (agents, out, in) weight and an (agents, out) bias tensor per layer, in agent order,
+        so that the whole population can go through the net in one batched pass.
+        """
+        genomes = torch.from_numpy(self.genomes)
+        self.layer_weights = [genomes[:, offset:offset + int(np.prod(shape))].reshape(len(genomes), *shape)
+                              for offset, shape in self.layout]
+
+    def forward(self, inputs, slots=None):
+        """
+        Run self.net on many agents at once, each with its own weights: one batched matrix multiply per layer
+        instead of a forward call per agent.
+        :param inputs: (agents, n_inputs) tensor, a row per agent or per agent slot in slots
+        :return: (agents, n_outputs) tensor of outputs
+        """
+        weights = self.layer_weights if slots is None else [weight[slots] for weight in self.layer_weights]
+        outputs = inputs
+        linear = 0
+        with torch.no_grad():
+            for layer in self.net:
+                if isinstance(layer, torch.nn.Linear):
+                    outputs = torch.baddbmm(weights[2 * linear + 1].unsqueeze(2), weights[2 * linear],
+                                            outputs.unsqueeze(2)).squeeze(2)
+                    linear += 1
+                else:
+                    outputs = layer(outputs)
+        return outputs
+
+    def plan_actions(self):
+        """
+        Work out every neural agent's outputs for this tick in one batched pass, from where everyone is before
+        anybody moves.
+        """
+        self.planned_inputs = self.agent.batch_inputs(self, self.schedule.agents[self.vis_agents:])
+        self.planned_outputs = self.forward(torch.from_numpy(self.planned_inputs))
+
+    def get_outputs(self, agent):
+        """
+        The agent's net outputs for its move. Under sequential activation they are the outputs for what it sees
+        now: the batched pass's, unless a move earlier in the tick changed its inputs, in which case they are
+        worked out again, so the moves are the same as with a forward pass per agent. Under planned activation they
+        are always the batched pass's, for what it saw at the start of the tick.
+        :return: (n_outputs,) tensor
+        """
+        slot = agent.unique_id - self.vis_agents
+        if self.activation == "sequential":
+            inputs = agent.get_inputs()
+            if not np.array_equal(inputs, self.planned_inputs[slot]):
+                return self.forward(torch.from_numpy(inputs[None]), [slot])[0]
+        return self.planned_outputs[slot]
+
     def generate_agents(self, agent):
         # Create agents
         for i in range(self.vis_agents, self.n + self.vis_agents):
@@ -98,45 +259,43 @@ class EvolutionModel(Model):
             agent.colour = color
 
     def sexual_reproduction(self):
-        # Generate pairs from agents
-        with torch.no_grad():
-            pairs = [[self.winners.pop(random.randint(0, len(self.winners) - 1)),
-                      self.winners.pop(random.randint(0, len(self.winners) - 1))] for _ in
-                     range(int(len(self.winners) // 2))]
-            # Iterate through pairs
-            for pair in pairs:
-                # Add to weights
-                for i in range(self.n // int(len(pairs))):
-                    if self.num_agents % self.n != 0 or self.num_agents == 0:
-                        new_weights = []
-                        for j in range(len(pair[0].weights)):
-                            new_weights.append(
-                                torch.Tensor(np.array([pair[random.randint(0, 1)].weights[j].cpu().flatten()[x] for x in
-                                                       range(len(pair[0].weights[j].flatten()))]).reshape(
-                                    pair[0].weights[j].shape)))
-                        self.num_agents += 1
-                        if self.random.random() < self.mutation_rate:
-                            section_to_mutate = new_weights[np.random.choice(range(len(new_weights)), 1,
-                                                                             p=[0.8 / (len(new_weights) / 2),
-                                                                                0.2 / (len(new_weights) / 2)] * int(
-                                                                                 (len(new_weights) / 2)))[0]]
-                            # print(section_to_mutate.shape)
-                            bias_shapes = [new_weights[x].shape for x in range(1, len(new_weights), 2)]
-                            if section_to_mutate.shape in bias_shapes:
-                                randomRow = np.random.randint(section_to_mutate.shape[0], size=1)
-                                section_to_mutate[randomRow] = np.random.randn()
-                            else:
-                                randomRow = np.random.randint(section_to_mutate.shape[0], size=1)
-                                randomCol = np.random.randint(section_to_mutate.shape[1], size=1)
-                                section_to_mutate[randomRow, randomCol] = np.random.randn()
-                        self.weights.append(new_weights)
+        """
+        Breed the next generation's genomes from this generation's winners, all children at once. The winners are
+        paired at random and each pair has an equal share of the n children, every parameter of a child coming from
+        either parent with even odds. A mutation_rate share of the children then have one parameter redrawn, in a
+        weight matrix 80% of the time and a bias vector 20%. If the children do not divide evenly into n, the agents
+        left over copy random children.
+        """
+        winners = np.array([agent.unique_id - self.vis_agents for agent in self.winners], dtype=np.int64)
+        self.winners = []
+        n_pairs = len(winners) // 2
+        if n_pairs == 0:
+            raise RuntimeError("Fewer than two agents were correct, so there are no parents for the next generation")
+        pairs = self.rng.permutation(winners)[:2 * n_pairs].reshape(n_pairs, 2)
+        parents = np.repeat(pairs, self.n // n_pairs, axis=0)
+        crossover = self.rng.random((len(parents), self.n_params)) < 0.5
+        children = np.where(crossover, self.genomes[parents[:, 0]], self.genomes[parents[:, 1]])
+
+        mutated = np.flatnonzero(self.rng.random(len(children)) < self.mutation_rate)
+        offsets = np.array([offset for offset, _ in self.layout])
+        sizes = np.array([int(np.prod(shape)) for _, shape in self.layout])
+        # The layout alternates weight matrices and bias vectors
+        section = self.rng.choice(len(self.layout), len(mutated),
+                                  p=np.tile([0.8, 0.2], len(self.layout) // 2) / (len(self.layout) // 2))
+        children[mutated, offsets[section] + self.rng.integers(0, sizes[section])] = \
+            self.rng.standard_normal(len(mutated), dtype=np.float32)
+
+        fill = self.rng.integers(0, len(children), self.n - len(children))
+        self.genomes = np.concatenate([children, children[fill]])
+        self.parents = np.concatenate([parents, parents[fill]]).astype(np.int32)
+        self.num_agents = len(self.genomes)
 
     def generate_visual_agents(self):
         return 0
 
 
 class ComplexClassificationModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate):
+    def __init__(self, n, width, height, max_age, mutation_rate, seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(20, 10),
             torch.nn.ReLU(),
@@ -144,7 +303,7 @@ class ComplexClassificationModel(EvolutionModel):
         )
         self.agent = ComplexNeuralAgent
 
-        super().__init__(n, width, height, max_age, mutation_rate)
+        super().__init__(n, width, height, max_age, mutation_rate, seed=seed, activation=activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 5:
@@ -170,7 +329,7 @@ class ComplexClassificationModel(EvolutionModel):
 
 
 class SimpleClassificationModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate):
+    def __init__(self, n, width, height, max_age, mutation_rate, seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(4, 10),
             torch.nn.ReLU(),
@@ -178,7 +337,7 @@ class SimpleClassificationModel(EvolutionModel):
         )
         self.agent = SimpleNeuralAgent
         self.colour = 0
-        super().__init__(n, width, height, max_age, mutation_rate)
+        super().__init__(n, width, height, max_age, mutation_rate, seed=seed, activation=activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 5:
@@ -204,13 +363,13 @@ class SimpleClassificationModel(EvolutionModel):
 
 
 class SimplestClassificationModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate):
+    def __init__(self, n, width, height, max_age, mutation_rate, seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(2, 5),
         )
         self.colour = 0
         self.agent = SimpleNeuralAgent
-        super().__init__(n, width, height, max_age, mutation_rate)
+        super().__init__(n, width, height, max_age, mutation_rate, seed=seed, activation=activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 2:
@@ -233,12 +392,13 @@ class SimplestClassificationModel(EvolutionModel):
 
 
 class RaceClassificationModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_"):
+    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_",
+                 seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(8, 6)
         )
         self.agent = RaceNeuralAgent
-        super().__init__(n, width, height, max_age, mutation_rate, save_path)
+        super().__init__(n, width, height, max_age, mutation_rate, save_path, seed, activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 4:
@@ -255,14 +415,15 @@ class RaceClassificationModel(EvolutionModel):
 
 
 class FourRaceClassificationModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_"):
+    def __init__(self, n, width, height, max_age, mutation_rate, save_path="saved_models/uncategorized/model_",
+                 seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(8, 10),
             torch.nn.ReLU(),
             torch.nn.Linear(10,6)
         )
         self.agent = FourRaceNeuralAgent
-        super().__init__(n, width, height, max_age, mutation_rate, save_path)
+        super().__init__(n, width, height, max_age, mutation_rate, save_path, seed, activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 4:
@@ -285,13 +446,13 @@ class FourRaceClassificationModel(EvolutionModel):
 
 
 class SimpleDownModel(EvolutionModel):
-    def __init__(self, n, width, height, max_age, mutation_rate):
+    def __init__(self, n, width, height, max_age, mutation_rate, seed=None, activation="sequential"):
         self.net = torch.nn.Sequential(
             torch.nn.Linear(3, 5)
         )
         self.agent = SimpleNeuralAgent
 
-        super().__init__(n, width, height, max_age, mutation_rate)
+        super().__init__(n, width, height, max_age, mutation_rate, seed=seed, activation=activation)
 
     def is_correct(self, agent):
         if agent.pos[1] < self.grid.height // 5:
@@ -300,6 +461,63 @@ class SimpleDownModel(EvolutionModel):
             return False
 
 
+def load_snapshot(path):
+    """
+    Rebuild a model from a snapshot written by EvolutionModel.checkpoint, in the state it was in when the snapshot
+    was taken. This includes the global random state, which the race models draw their colours from.
+    :return: the model
+    """
+    meta, arrays = read_snapshot(path)
+    model = globals()[meta["model"]](**meta["params"])
+    model.save_file_path = meta["save_path"]
+    model.save_iterator = meta["save_iterator"]
+    model.steps = meta["steps"]
+    model.count = meta["count"]
+    model.correct = meta["correct"]
+    model.genomes = arrays["genomes"]
+    model.parents = arrays["parents"]
+    model.stack_weights()
+    agents = model.schedule.agents[model.vis_agents:]
+    for agent in agents:
+        model.grid.remove_agent(agent)
+    for agent, pos in zip(agents, arrays["positions"].tolist()):
+        model.grid.place_agent(agent, tuple(pos))
+    if "colours" in arrays:
+        for agent, colour in zip(agents, arrays["colours"].tolist()):
+            agent.colour = colour
+    model.datacollector.model_vars["Correct"] = arrays["history"].tolist()
+    model.rng.bit_generator.state = meta["rng"]
+    # An instance Random, as mesa's Model.__new__ shares one between every model of a class
+    model.random = random.Random()
+    model.random.setstate(as_random_state(meta["random"]))
+    random.setstate(as_random_state(meta["global_random"]))
+    return model
+
+
+def as_random_state(state):
+    """
+    :return: a random.getstate() tuple back from its JSON lists
+    """
+    version, internal, gauss = state
+    return version, tuple(internal), gauss
+
+
+def genome_layout(net):
+    """
+    Where each Linear layer's weight and bias sit in a flat genome, in the order weight, bias of the first layer,
+    then of the next.
+    :return: list of (offset, shape) for each tensor
+    """
+    layout = []
+    offset = 0
+    for layer in net:
+        if isinstance(layer, torch.nn.Linear):
+            for tensor in [layer.weight, layer.bias]:
+                layout.append((offset, tuple(tensor.shape)))
+                offset += int(np.prod(tensor.shape))
+    return layout
+
+
 def correct_amount(model):
     return len([x for x in model.schedule.agents if model.is_correct(x)])
 
@@ -0,0 +1,39 @@
+import numpy as np
+from mesa.space import SingleGrid
+
+EMPTY, OCCUPIED, OUT_OF_BOUNDS = range(3)
+
+
+class OccupancyGrid(SingleGrid):
+    """
+    A SingleGrid that keeps an occupancy array alongside, padded by pad cells of OUT_OF_BOUNDS on every side, so
+    that every neighbourhood within pad cells can be read with plain indexing and no edge cases. Cell (x, y) is
+    occupancy[x + pad, y + pad], EMPTY or OCCUPIED.
+    """
+
+    def __init__(self, width, height, torus, pad=1):
+        super().__init__(width, height, torus)
+        self.pad = pad
+        self.occupancy = np.full((width + 2 * pad, height + 2 * pad), OUT_OF_BOUNDS, dtype=np.int8)
+        self.occupancy[pad:pad + width, pad:pad + height] = EMPTY
+
+    def _place_agent(self, pos, agent):
+        super()._place_agent(pos, agent)
+        self.occupancy[pos[0] + self.pad, pos[1] + self.pad] = OCCUPIED
+
+    def _remove_agent(self, pos, agent):
+        super()._remove_agent(pos, agent)
+        self.occupancy[pos[0] + self.pad, pos[1] + self.pad] = EMPTY
+
+    def sense(self, positions, offsets, values):
+        """
+        Read the cells at offsets from many positions at once.
+        :param positions: (agents, 2) array of cells
+        :param offsets: (sensors, 2) array of (dx, dy), each at most pad away
+        :param values: what EMPTY, OCCUPIED and OUT_OF_BOUNDS read as
+        :return: (agents, sensors) float32 array
+        """
+        offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        x = positions[:, 0, None] + offsets[:, 0] + self.pad
+        y = positions[:, 1, None] + offsets[:, 1] + self.pad
+        return np.asarray(values, dtype=np.float32)[self.occupancy[x, y]]
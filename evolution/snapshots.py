@@ -0,0 +1,88 @@
+import glob
+import json
+import os
+import queue
+import re
+import threading
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+
+
+class BackgroundWriter:
+    """
+    Runs file writes on a background thread, one at a time in the order they were submitted, so the simulation never
+    waits on the disk. An error in a write is raised by the next submit or flush.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            function, args = self.jobs.get()
+            try:
+                function(*args)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, function, *args):
+        self.check()
+        self.jobs.put((function, args))
+
+    def flush(self):
+        """
+        Wait for every submitted write to finish.
+        """
+        self.jobs.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def save_snapshot(path, meta, arrays):
+    """
+    Write a snapshot as an npz of arrays plus the UTF-8 bytes of a JSON meta entry, under a temporary name first so
+    that a reader never finds half a file.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    partial = path + ".partial"
+    with open(partial, "wb") as f:
+        meta = json.dumps(dict(meta, version=SNAPSHOT_VERSION)).encode()
+        np.savez(f, meta=np.frombuffer(meta, dtype=np.uint8), **arrays)
+    os.replace(partial, path)
+
+
+def read_snapshot(path):
+    """
+    :return: the snapshot's meta dict and a dict of its arrays
+    """
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(data["meta"].tobytes())
+        if meta["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is a version {meta['version']} snapshot, only version {SNAPSHOT_VERSION} "
+                             f"can be read")
+        return meta, {name: data[name] for name in data.files if name != "meta"}
+
+
+def latest_snapshot(prefix):
+    """
+    :return: path of the snapshot saved under prefix with the highest generation number, or None if there are none
+    """
+    snapshots = {}
+    for path in glob.glob(glob.escape(prefix) + "*.npz"):
+        match = re.fullmatch(r"(\d+)\.npz", path[len(prefix):])
+        if match:
+            snapshots[int(match.group(1))] = path
+    return snapshots[max(snapshots)] if snapshots else None
@@ -0,0 +1,46 @@
+import random
+
+import torch
+
+from models import *
+
+
+class UnbatchedFourRaceModel(FourRaceClassificationModel):
+    """
+    Sequential activation as it was before moves were batched: every agent runs its own forward pass on its own
+    inputs when its turn comes.
+    """
+
+    def plan_actions(self):
+        pass
+
+    def get_outputs(self, agent):
+        return self.forward(torch.from_numpy(agent.get_inputs()[None]), [agent.unique_id - self.vis_agents])[0]
+
+
+def run_positions(model_class, activation="sequential", seed=5, ticks=50):
+    # Agents are first placed with the global random module
+    random.seed(seed)
+    model = model_class(n=40, width=12, height=12, max_age=20, mutation_rate=0.5, seed=seed, activation=activation)
+    model.save_iterator = ticks + 1
+    positions = []
+    for _ in range(ticks):
+        model.step()
+        positions.append(sorted((agent.unique_id, agent.pos) for agent in model.schedule.agents))
+    return positions
+
+
+def test_sequential_moves_match_unbatched_reference():
+    assert run_positions(FourRaceClassificationModel) == run_positions(UnbatchedFourRaceModel)
+
+
+def test_planned_activation_differs_from_sequential():
+    assert run_positions(FourRaceClassificationModel, "planned") != run_positions(FourRaceClassificationModel)
+
+
+def test_unknown_activation_is_refused():
+    try:
+        FourRaceClassificationModel(n=4, width=5, height=5, max_age=5, mutation_rate=0.5, activation="batched")
+    except ValueError:
+        return
+    raise AssertionError("activation batched was accepted")
@@ -1,22 +1,30 @@
 from mesa import Agent
 
+from counters import SUSCEPTIBLE, INFECTED, RECOVERED, QUARANTINED, DEAD, age_band
+from schedules import generate_daily_schedule
+
 
 class Person(Agent):
     """
     A person in the model.
     """
+    masked = False
 
     def __init__(self, unique_id, model, house, age):
         super().__init__(unique_id, model)
         self.asymptomatic = None
         self.house = house
         self.age = age
+        self.alive = True
         self.infected = False
         self.quarantined = False
-        self.time_infected = 0
+        self.infected_at = None
+        self.symptoms_at = None
+        self.recovers_at = None
+        self.quarantined_at = None
+        self.immune_until = None
         self.time_quarantined = 0
         self.immune = False
-        self.time_recovered = 0
         self.spouse = None
         self.default_type = "Person"
         self.type = self.default_type
@@ -32,65 +40,107 @@ class Person(Agent):
             self.death_probability = 0.005
 
         self.normal_schedule, self.lockdown_schedule = self.generate_daily_schedule()
-        self.quarantine_schedule = [[self.house for _ in range(24)] for _ in range(7)]
-        self.active_schedule = self.normal_schedule
+        self.quarantine_schedule = self.model.schedule_table.home_row
+        self.counter_key = (int(self.masked), age_band(self.age))
+        self.model.counters.add(SUSCEPTIBLE, *self.counter_key)
 
     def step(self):
         """
-        Agent's step
+        Agent's step. Disease timers are handled by events on the model's queue, so this is only the move.
         :return:
         """
-        if self.infected:
-            self.time_infected += 1
-            if self.time_infected == self.model.infection_length * 24:
-                self.infected = False
-                self.immune = True
-                self.time_recovered = 0
-                self.time_infected = 0
-            if not self.quarantined and self.time_infected >= self.model.time_till_symptoms * 24 and not self.asymptomatic and self.random.random() < 0.5:
-                self.quarantine_toggle()
-
-
-            if len(self.model.grid.grid[self.pos[0]][self.pos[1]]) > 1:
-                for agent in self.model.grid.grid[self.pos[0]][self.pos[1]]:
-                    if not agent.infected and not agent.immune:
-                        self.interact(agent)
-        if self.immune:
-            self.time_recovered += 1
-            if self.time_recovered == self.model.immunity_length * 24:
-                self.immune = False
-                self.time_recovered = 0
+        self.model.grid.move_agent(self, self.scheduled_position(self.model.age % 7, self.model.time))
+
+    def recover(self):
+        if not self.infected or self.model.hours != self.recovers_at:
+            return
+        self.infected = False
+        self.immune = True
+        self.model.counters.move(INFECTED, RECOVERED, *self.counter_key)
+        if self.model.immunity_length > 0:
+            self.immune_until = self.model.hours + self.model.immunity_length * 24 - 1
+            self.model.events.schedule(self.immune_until, self, "lose_immunity")
+
+    def lose_immunity(self):
+        if not self.immune or self.model.hours != self.immune_until:
+            return
+        self.immune = False
+        self.model.counters.move(RECOVERED, SUSCEPTIBLE, *self.counter_key)
 
+    def show_symptoms(self):
+        """
+        From symptom onset until recovery an unquarantined person has an even chance each hour of going into
+        quarantine, so the hour it happens is drawn up front. Quarantined people wait for their release.
+        :return:
+        """
+        if not self.infected or self.quarantined or self.asymptomatic:
+            return
+        delay = 0
+        while self.random.random() >= 0.5:
+            delay += 1
+        if self.model.hours + delay < self.recovers_at:
+            self.model.events.schedule(self.model.hours + delay, self, "start_quarantine")
+
+    def start_quarantine(self):
+        if self.infected and not self.quarantined:
+            self.quarantine_toggle()
+
+    def end_quarantine(self):
+        if not self.quarantined:
+            return
+        self.time_quarantined += self.model.hours - self.quarantined_at + 1
+        self.quarantine_toggle()
+        if self.infected and not self.asymptomatic and self.symptoms_at <= self.model.hours + 1 < self.recovers_at:
+            self.model.events.schedule(self.model.hours + 1, self, "show_symptoms")
+
+    def attempt_death(self):
+        if not self.infected or self.model.hours != self.infected_at + self.death_attempt_day * 24 - 1:
+            return
+        if self.random.random() < self.death_probability:
+            self.die()
+
+    @property
+    def compartment(self):
+        return INFECTED if self.infected else (RECOVERED if self.immune else SUSCEPTIBLE)
+
+    @property
+    def active_schedule(self):
+        """
+        Resolved on every lookup from the quarantine flag and the model's lockdown flag, so entering or lifting a
+        lockdown never has to touch the agents.
+        """
         if self.quarantined:
-            self.time_quarantined += 1
-            if self.time_quarantined == self.model.quarantine_length * 24:
-                self.quarantine_toggle()
-
-        self.model.grid.move_agent(self, self.active_schedule[self.model.age % 7][self.model.time])
-        if self.infected:
-            if self.time_infected == self.death_attempt_day * 24:
-                if self.random.random() < self.death_probability:
-                    self.die()
-
-    def interact(self, other):
-        if self.infected and not other.infected and not other.immune and not self.active_schedule[self.model.age % 7][
-                                                                                 self.model.time - 1] == \
-                                                                             other.active_schedule[other.age % 7][
-                                                                                 other.model.time - 1]:
-            self.attempt_infection(other)
-
-    def attempt_infection(self, other):
-        if self.model.random.random() < (
-                self.model.infection_probability * (self.infection_modifier * other.infection_modifier)):
-            other.infect()
+            return self.quarantine_schedule
+        return self.lockdown_schedule if self.model.lockdown_active else self.normal_schedule
+
+    def scheduled_position(self, day, hour):
+        return self.model.schedule_table.position(self.active_schedule, day, hour, self.house)
 
     def infect(self):
+        if not self.infected:
+            self.model.counters.move(SUSCEPTIBLE, INFECTED, *self.counter_key)
         self.infected = True
-        self.time_infected = 0
         self.model.total_cases += 1
         self.type = "Infected"
         self.asymptomatic = self.model.random.random() < self.model.asymptomatic_probability
         self.death_attempt_day = self.model.random.randint(0, self.model.infection_length - 1)
+        self.schedule_infection_events()
+
+    def schedule_infection_events(self):
+        """
+        Queue everything an infection leads to. A timer that reaches n days in the hour of infection's step is due
+        n * 24 - 1 hours after it.
+        :return:
+        """
+        events = self.model.events
+        self.infected_at = self.model.hours
+        self.recovers_at = self.infected_at + self.model.infection_length * 24 - 1
+        self.symptoms_at = max(self.infected_at + self.model.time_till_symptoms * 24 - 1, self.infected_at)
+        events.schedule(self.recovers_at, self, "recover")
+        if not self.asymptomatic and self.symptoms_at < self.recovers_at:
+            events.schedule(self.symptoms_at, self, "show_symptoms")
+        if self.death_attempt_day > 0:
+            events.schedule(self.infected_at + self.death_attempt_day * 24 - 1, self, "attempt_death")
 
     def set_spouse(self, spouse):
         self.spouse = spouse
@@ -98,68 +148,43 @@ class Person(Agent):
 
     def quarantine_toggle(self):
         self.quarantined = not self.quarantined
+        self.model.counters.add(QUARANTINED, *self.counter_key, 1 if self.quarantined else -1)
+        if self.quarantined:
+            # Like the old hourly counter, time served is never reset, so only a first quarantine ever ends
+            self.quarantined_at = self.model.hours
+            if self.time_quarantined < self.model.quarantine_length * 24:
+                self.model.events.schedule(
+                    self.quarantined_at + self.model.quarantine_length * 24 - self.time_quarantined - 1, self,
+                    "end_quarantine")
         self.type = "Quarantined" if self.quarantined else self.default_type
-        self.active_schedule = self.quarantine_schedule if self.quarantined else (self.normal_schedule if not self.model.lockdown_active else self.lockdown_schedule)
 
 
     def generate_daily_schedule(self):
-        schedule = [[self.house for _ in range(24)] for _ in range(7)]
-        lockdown_schedule = [[self.house for _ in range(24)] for _ in range(7)]
-        if self.age > 17:
-            work_place = self.random.choice(self.model.workplaces)
-        else:
-            work_place = self.random.choice(self.model.schools)
-        shop = self.random.choice(self.model.shops)
-        for j in range(0, 4):
-            for i in range(9, 17):
-                schedule[j][i] = work_place
-                if self.age > 17:
-                    if self.random.random() < 0.2:
-                        lockdown_schedule[j][i] = work_place
-            if self.random.random() < 0.4:
-                for i in range(18, 20):
-                    schedule[j][i] = shop
-                if self.random.random() < 0.05:
-                    for i in range(18, 20):
-                        lockdown_schedule[j][i] = shop
-
-        if self.random.random() < 0.8:
-            shop_time = self.random.randint(10, 20)
-            for i in range(shop_time, shop_time + 2):
-                schedule[5][i] = shop
-
-            if self.random.random() < 0.05:
-                for i in range(shop_time, shop_time + 2):
-                    lockdown_schedule[5][i] = shop
-
-        if self.spouse:
-            schedule[6][10] = self.spouse.daily_schedule[6][10]
-            lockdown_schedule[6][10] = self.spouse.lockdown_schedule[6][10]
-        else:
-            if self.random.random() < 0.5:
-                church_choice = self.random.choice(self.model.churches)
-                schedule[6][10] = church_choice
-                if self.random.random() < 0.05:
-                    lockdown_schedule[6][10] = church_choice
-
-        return schedule, lockdown_schedule
+        spouse_schedules = (self.spouse.normal_schedule, self.spouse.lockdown_schedule) if self.spouse else None
+        return generate_daily_schedule(self.model, self.age, spouse_schedules)
 
     def die(self):
+        self.alive = False
         if self.spouse:
             self.spouse.spouse = None
         self.model.grid.remove_agent(self)
         self.model.schedule.remove(self)
         self.model.dead_people += 1
+        self.model.counters.move(INFECTED, DEAD, *self.counter_key)
+        if self.quarantined:
+            self.model.counters.add(QUARANTINED, *self.counter_key, -1)
 
 
 
 class MaskedPerson(Person):
+    masked = True
+    # Share of the time the mask is worn. Lockdowns do not change it, so the infection modifier is fixed
+    mask_wear_rate = 0.4
 
     def __init__(self, unique_id, model, house, age):
         super().__init__(unique_id, model, house, age)
         self.default_type = "Masked"
         self.type = self.default_type
-        self.mask_wear_rate = 0.4
         self.infection_modifier = 0.5 * self.mask_wear_rate
 
 
@@ -0,0 +1,345 @@
+import numpy as np
+
+import progression
+from models import *
+from schedules import ScheduleTable, generate_daily_schedule
+from transmission import infection_chance
+
+
+class TownGrid:
+    """
+    The size of the town that the array engine's flat cell indices refer to. Nobody is placed on it, so unlike a
+    MultiGrid it holds no cells and costs nothing to build, however large the town.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+
+class ArrayPandemicModel(PandemicModel):
+    """
+    The pandemic model with every person's state held in NumPy arrays.
+
+    Takes the same parameters as PandemicModel and draws the same town and
+    population from the same seed, but instead of activating a Person object
+    per agent it advances the whole population once per hour with array
+    operations. Persons are not created, so the scheduler stays empty and the
+    grid is only a TownGrid giving the town's size; locations are flat cell
+    indices (x * height + y) and schedules are rows of the model's shared
+    ScheduleTable.
+
+    A population from population.build_population or cached_population can be
+    passed in instead, in which case the town and people are taken from it and
+    only the initial infections are drawn from the seed.
+    """
+
+    def __init__(self, *args, population=None, **kwargs):
+        self.population = population
+        super().__init__(*args, **kwargs)
+
+    def create_grid(self, width, height):
+        return TownGrid(width, height)
+
+    def step(self, infections=None, quarantines=None):
+        """
+        Advance one hour. infections and quarantines, when given, are masks over all people that replace this hour's
+        random infection and symptomatic quarantine draws; fast_forward uses them for outcomes it has already drawn.
+        :return:
+        """
+        day, hour = self.age % 7, self.time
+        self.transmit(day, hour, infections)
+        self.progress_infections(quarantines)
+        self.progress_immunity()
+        self.progress_quarantine()
+        self.position = self.active_location(np.arange(self.n_agents), day, hour)
+        self.attempt_deaths()
+        self.finish_hour()
+
+    def progress_infections(self, quarantines=None):
+        progression.progress_infections(self, self.rng, quarantines)
+
+    def symptomatic(self, hours_ahead=0):
+        return progression.symptomatic(self, hours_ahead)
+
+    def transmit(self, day, hour, infections=None):
+        """
+        Infect susceptible people who share a cell with infected people, with the same pairwise chances and schedule
+        condition as PandemicModel.transmit.
+        :return:
+        """
+        if infections is not None:
+            if self.contact_log is not None:
+                targets, probability = self.infection_chances(day, hour)
+                self.log_contacts(day, hour, targets, probability, infections[targets])
+            self.infect(np.flatnonzero(infections))
+            return
+        targets, probability = self.infection_chances(day, hour)
+        infected = self.rng.random(len(targets)) < probability
+        if self.contact_log is not None:
+            self.log_contacts(day, hour, targets, probability, infected)
+        self.infect(targets[infected])
+
+    def log_contacts(self, day, hour, targets, probability, infected):
+        """
+        Pass the hour's transmission to the contact log, before the newly infected people become sources.
+        :return:
+        """
+        sources = np.flatnonzero(self.infected)
+        previous_hour = (hour - 1) % 24
+        self.contact_log.record(
+            self.hours,
+            (sources, self.position[sources], self.active_location(sources, day, previous_hour),
+             self.infection_modifier[sources]),
+            (targets, self.position[targets], self.active_location(targets, self.ages[targets] % 7, previous_hour),
+             self.infection_modifier[targets]),
+            probability, infected, self.infection_probability)
+
+    def infection_chances(self, day, hour):
+        """
+        :return: the susceptible people and each one's chance of being infected in the given hour
+        """
+        sources = np.flatnonzero(self.infected)
+        targets = np.flatnonzero(self.alive & ~self.infected & ~self.immune)
+        if len(sources) == 0 or len(targets) == 0:
+            return targets, np.zeros(len(targets))
+        previous_hour = (hour - 1) % 24
+        probability = infection_chance(
+            self.position[sources], self.active_location(sources, day, previous_hour),
+            self.infection_modifier[sources],
+            self.position[targets], self.active_location(targets, self.ages[targets] % 7, previous_hour),
+            self.infection_modifier[targets],
+            self.infection_probability, self.n_cells)
+        return targets, probability
+
+    def fast_forward(self, hours):
+        """
+        Advance the model by hours, giving the same hourly series in distribution as calling step that many times.
+
+        Between schedule change points and timer thresholds every hour repeats the previous one: nobody moves, the
+        infectious pressure in each cell is unchanged and the only random events are infections and symptomatic
+        quarantines, each with a fixed hourly chance. The hour of each person's next such event is drawn at once
+        (geometric with the hourly chance), the quiet hours before the first of them only advance the timers and
+        the clock, and that hour is then stepped with the drawn outcomes.
+        :return:
+        """
+        end = self.hours + hours
+        while self.hours < end:
+            lockdown_active = self.lockdown_active
+            self.step()
+            if self.lockdown_active != lockdown_active:
+                # People moved on the old schedules before the lockdown check, so the change points do not apply yet
+                continue
+            quiet = self.quiet_hours(end - self.hours)
+            if quiet < 2:
+                continue
+            day, hour = self.age % 7, self.time
+            targets, probability = self.infection_chances(day, hour)
+            first_infection = np.full(self.n_agents, np.iinfo(np.int64).max)
+            exposed = targets[probability > 0]
+            first_infection[exposed] = self.rng.geometric(probability[probability > 0])
+            first_quarantine = np.full(self.n_agents, np.iinfo(np.int64).max)
+            symptomatic = np.flatnonzero(self.symptomatic(hours_ahead=1))
+            first_quarantine[symptomatic] = self.rng.geometric(0.5, len(symptomatic))
+            first_event = min(first_infection.min(), first_quarantine.min())
+            if first_event > quiet:
+                self.skip_hours(quiet)
+            else:
+                if first_event > 1:
+                    self.skip_hours(first_event - 1)
+                if self.hours < end:
+                    self.step(first_infection == first_event, first_quarantine == first_event)
+
+    def quiet_hours(self, limit):
+        """
+        Count the coming hours, up to limit, in which nothing but infections and symptomatic quarantines could
+        happen: no schedule change point and no timer reaching its threshold. Lockdown checks only depend on the
+        counters, which the last step already settled.
+        :return:
+        """
+        changes = self.schedule_changes()[self.lockdown_active]
+        slot = (self.age % 7) * 24 + self.time
+        upcoming = np.roll(changes, -slot)[1:]
+        quiet = int(np.argmax(upcoming)) + 1 if upcoming.any() else limit
+
+        presymptomatic = self.infected & ~self.symptomatic(hours_ahead=1) & ~self.asymptomatic & ~self.quarantined
+        thresholds = [self.infection_length * 24 - self.time_infected[self.infected],
+                      self.death_attempt_day[self.infected] * 24 - self.time_infected[self.infected],
+                      self.time_till_symptoms * 24 - self.time_infected[presymptomatic],
+                      self.immunity_length * 24 - self.time_recovered[self.immune],
+                      self.quarantine_length * 24 - self.time_quarantined[self.quarantined]]
+        for hours_left in thresholds:
+            hours_left = hours_left[hours_left > 0]
+            if len(hours_left):
+                quiet = min(quiet, int(hours_left.min()) - 1)
+        return min(quiet, limit)
+
+    def skip_hours(self, hours):
+        """
+        Advance through hours in which nothing happens: the timers and the clock move on, the reporters are collected
+        every hour and positions follow the schedule at the last of them.
+        :return:
+        """
+        self.time_infected[self.infected] += hours
+        self.time_recovered[self.immune] += hours
+        self.time_quarantined[self.quarantined] += hours
+        for _ in range(hours - 1):
+            self.finish_hour()
+        self.position = self.active_location(np.arange(self.n_agents), self.age % 7, self.time)
+        self.finish_hour()
+
+    def schedule_changes(self):
+        """
+        Mark the hours of the week (day * 24 + hour) whose step differs from the step before for anyone on the normal
+        schedules (index False) or the lockdown schedules (index True): someone's position at the start of the hour
+        or the previous-hour locations that transmission compares.
+        """
+        if self._schedule_changes is None:
+            self._schedule_changes = {}
+            for lockdown, rows in [(False, self.normal_schedule), (True, self.lockdown_schedule)]:
+                table = self.schedule_table.table[np.unique(rows)]
+                positions = np.roll(table.reshape(len(table), 7 * 24), 1, axis=1)
+                source_keys = np.roll(table, 1, axis=2).reshape(len(table), 7 * 24)
+                target_keys = np.roll(table, 1, axis=2)
+                target_changes = (target_keys != np.roll(target_keys, 1, axis=2)).any(axis=(0, 1))
+                self._schedule_changes[lockdown] = ((positions != np.roll(positions, 1, axis=1)).any(axis=0)
+                                                    | (source_keys != np.roll(source_keys, 1, axis=1)).any(axis=0)
+                                                    | np.tile(target_changes, 7))
+        return self._schedule_changes
+
+    def progress_immunity(self):
+        progression.progress_immunity(self)
+
+    def progress_quarantine(self):
+        progression.progress_quarantine(self)
+
+    def attempt_deaths(self):
+        self.dead_people += int(np.count_nonzero(progression.attempt_deaths(self, self.rng)))
+
+    def add_counts(self, compartment, people, amount=1):
+        self.counters.add_many(compartment, self.group[people], self.band[people], amount)
+
+    def move_counts(self, source, destination, people):
+        self.counters.move_many(source, destination, self.group[people], self.band[people])
+
+    def infect(self, indices):
+        self.counters.move_many(SUSCEPTIBLE, INFECTED, self.group[indices], self.band[indices])
+        self.infected[indices] = True
+        self.time_infected[indices] = 0
+        self.total_cases += len(indices)
+        self.asymptomatic[indices] = self.rng.random(len(indices)) < self.asymptomatic_probability
+        self.death_attempt_day[indices] = self.rng.integers(0, self.infection_length, len(indices))
+
+    def active_location(self, indices, day, hour):
+        """
+        Resolve where people are scheduled to be: at home when quarantined, otherwise on the lockdown or normal
+        schedule depending on the model's lockdown flag.
+        :return: flat cell index for each person in indices
+        """
+        schedule = self.lockdown_schedule if self.lockdown_active else self.normal_schedule
+        rows = np.where(self.quarantined[indices], self.schedule_table.home_row, schedule[indices])
+        return self.schedule_table.cells(rows, day, hour, self.house[indices])
+
+    def create_agents(self, children_percentage, n_couples, n_single):
+        if self.population is not None:
+            self.set_population(*(self.population[name] for name in ["ages", "house", "position", "masked",
+                                                                      "normal_schedule", "lockdown_schedule"]))
+            return
+        ages, houses, positions, masked, normal, lockdown = [], [], [], [], [], []
+
+        def add_person(house, age, is_masked):
+            normal_schedule, lockdown_schedule = generate_daily_schedule(self, age)
+            ages.append(age)
+            houses.append(house)
+            masked.append(is_masked)
+            normal.append(normal_schedule)
+            lockdown.append(lockdown_schedule)
+
+        for i in range(n_single):
+            house = self.cell_index(self.assign_house_cell())
+            add_person(house, self.random.randint(18, 65), i < n_single * self.masked_percentage)
+            positions.append(self.cell_index(self.assign_house_cell()))
+
+        for i in range(n_couples):
+            couple_house = self.cell_index(self.assign_house_cell())
+            couple_ages = [self.random.randint(18, 65)]
+            couple_ages.append(self.random.randint(couple_ages[0] - 5, couple_ages[0] + 5))
+            for j in range(2):
+                add_person(couple_house, couple_ages.pop(), i < n_couples * self.masked_percentage)
+                positions.append(couple_house)
+            if i < n_couples * children_percentage:
+                add_person(couple_house, self.random.randint(0, 17), masked[-1])
+                positions.append(couple_house)
+
+        self.set_population(ages, houses, positions, masked, normal, lockdown)
+
+    def build_town(self, n, n_couples, house_depth, n_schools, n_workplaces, n_shops, n_churches):
+        """
+        Lay out the town like PandemicModel, or take it from the population given to the model.
+        :return:
+        """
+        if self.population is None:
+            super().build_town(n, n_couples, house_depth, n_schools, n_workplaces, n_shops, n_churches)
+            return
+        for name in ["schools", "workplaces", "shops", "churches", "empty_house_cells", "unused_cells"]:
+            setattr(self, name, [tuple(cell) for cell in self.population[name].tolist()])
+        self.schedule_table = ScheduleTable.from_arrays(self.grid.height, self.population["schedule_table"],
+                                                        self.population["venues"])
+
+    def set_population(self, ages, houses, positions, masked, normal, lockdown):
+        """
+        Set up the state arrays of a population that has not been infected yet.
+        :return:
+        """
+        self.n_agents = len(ages)
+        self.n_cells = self.grid.width * self.grid.height
+        self.ages = np.array(ages, dtype=np.int32)
+        self.house = np.array(houses, dtype=np.int64)
+        self.position = np.array(positions, dtype=np.int64)
+        self.masked = np.array(masked, dtype=bool)
+        self.normal_schedule = np.array(normal, dtype=np.int32)
+        self.lockdown_schedule = np.array(lockdown, dtype=np.int32)
+        self.group = self.masked.astype(np.intp)
+        self.band = np.searchsorted(AGE_BANDS, self.ages)
+        self.counters.add_many(SUSCEPTIBLE, self.group, self.band)
+        self.infection_modifier = np.where(self.masked, 0.5 * 0.4, 1.0)
+        self.death_probability = np.select([self.ages > 60, self.ages > 40, self.ages > 20], [0.1, 0.03, 0.01], 0.005)
+
+        self.alive = np.ones(self.n_agents, dtype=bool)
+        self.infected = np.zeros(self.n_agents, dtype=bool)
+        self.immune = np.zeros(self.n_agents, dtype=bool)
+        self.quarantined = np.zeros(self.n_agents, dtype=bool)
+        self.asymptomatic = np.zeros(self.n_agents, dtype=bool)
+        self.time_infected = np.zeros(self.n_agents, dtype=np.int32)
+        self.time_recovered = np.zeros(self.n_agents, dtype=np.int32)
+        self.time_quarantined = np.zeros(self.n_agents, dtype=np.int32)
+        self.death_attempt_day = np.zeros(self.n_agents, dtype=np.int32)
+        self._schedule_changes = None
+
+    def cell_index(self, pos):
+        return pos[0] * self.grid.height + pos[1]
+
+    def infect_agents(self, initial_infected_percentage):
+        # Drawn with the model's random module in the same order as PandemicModel.infect_agents and Person.infect
+        def infect(idx):
+            if not self.infected[idx]:
+                self.counters.move(SUSCEPTIBLE, INFECTED, self.group[idx], self.band[idx])
+            self.infected[idx] = True
+            self.time_infected[idx] = 0
+            self.total_cases += 1
+            self.asymptomatic[idx] = self.random.random() < self.asymptomatic_probability
+            self.death_attempt_day[idx] = self.random.randint(0, self.infection_length - 1)
+
+        for idx in range(self.n_agents):
+            if self.random.random() < initial_infected_percentage:
+                infect(idx)
+        infect(self.random.randrange(self.n_agents))
+        self.rng = np.random.default_rng(self.random.getrandbits(64))
+
+    def scan_compartments(self):
+        counts = np.zeros_like(self.counters.counts[:DEAD])
+        susceptible = self.alive & ~self.infected & ~self.immune
+        for compartment, members in [(SUSCEPTIBLE, susceptible), (INFECTED, self.infected),
+                                     (RECOVERED, self.immune), (QUARANTINED, self.quarantined)]:
+            np.add.at(counts[compartment], (self.group[members], self.band[members]), 1)
+        return counts
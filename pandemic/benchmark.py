@@ -0,0 +1,182 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import subprocess
+import time
+
+import numpy as np
+
+from array_model import ArrayPandemicModel
+from models import PandemicModel
+
+ENGINES = {"object": PandemicModel, "array": ArrayPandemicModel}
+PHASES = ["movement", "transmission", "progression", "reporters", "lockdown"]
+# The batcher's town of 400, which the larger towns are scaled up from
+BASE_PARAMS = dict(n=400, width=50, height=50, masked_percentage=0.3, asymptomatic_probability=0.2,
+                   infection_length=10, infection_probability=0.12, time_till_symptoms=5, quarantine_length=14,
+                   immunity_length=50, n_workplaces=25, n_shops=5, n_schools=2, n_churches=2, n_couples=150,
+                   couples_with_kids_percentage=0.7, initial_infected_percentage=0.005, house_depth=4,
+                   lockdown_threshold=0.05, liftlockdown_threshold=0.01)
+
+
+def house_count(width, house_depth):
+    """
+    :return: the size of house_cells(width, width, house_depth), without building it
+    """
+    return sum(2 * (width - i) + 2 * max(width - 2 * i - 1, 0) for i in range(1, house_depth + 1))
+
+
+def scaled_params(n, house_depth=None, grid_scale=1.0):
+    """
+    The batcher's town scaled to n people: couples and venues in proportion, and a square grid with room for every
+    household, times grid_scale. With house_depth None the town keeps BASE_PARAMS' proportions: its side and the
+    depth of its rings of houses grow with the square root of n from BASE_PARAMS' width and house_depth, so people
+    and venues per cell stay as in the base town and n=400 is the base town itself. The rings are deepened if the
+    households need more room. With a house_depth the grid is the smallest one with room at that depth, which grows
+    linearly with n.
+    :return: model keyword arguments
+    """
+    scale = n / BASE_PARAMS["n"]
+    params = dict(BASE_PARAMS, n=n, n_couples=round(BASE_PARAMS["n_couples"] * scale))
+    for name in ["n_workplaces", "n_shops", "n_schools", "n_churches"]:
+        params[name] = max(1, round(BASE_PARAMS[name] * scale))
+
+    def houses(n, n_couples):
+        # Singles take two house cells, one to live in and one to start in
+        return 2 * (n - 2 * n_couples) + n_couples
+
+    def smallest_width(households, house_depth):
+        width = 2 * house_depth + 2
+        while house_count(width, house_depth) < households:
+            width += 1
+        return width
+
+    needed = houses(n, params["n_couples"])
+    if house_depth is None:
+        width = max(math.ceil(BASE_PARAMS["width"] * math.sqrt(scale)), math.isqrt(needed - 1) + 1)
+        house_depth = max(1, round(BASE_PARAMS["house_depth"] * math.sqrt(scale)))
+        while house_count(width, house_depth) < needed:
+            house_depth += 1
+    else:
+        width = smallest_width(needed, house_depth)
+    params["house_depth"] = house_depth
+    params["width"] = params["height"] = max(width, round(width * grid_scale))
+    return params
+
+
+class PhaseTimer:
+    """
+    Times the phases of a model's step by wrapping the methods that make them up on the model instance.
+
+    Transmission is transmit, progression the disease timers (the event queue or the array timers), reporters the
+    DataCollector and lockdown the rest of finish_hour: the clock and the threshold checks. Movement is whatever is
+    left of the step.
+    """
+
+    def __init__(self, model):
+        self.totals = dict.fromkeys(PHASES + ["step", "finish_hour"], 0.0)
+        self.wrap(model, "step", "step")
+        self.wrap(model, "transmit", "transmission")
+        self.wrap(model, "finish_hour", "finish_hour")
+        self.wrap(model.datacollector, "collect", "reporters")
+        names = ["progress_infections", "progress_immunity", "progress_quarantine", "attempt_deaths"] \
+            if isinstance(model, ArrayPandemicModel) else ["process_events"]
+        for name in names:
+            self.wrap(model, name, "progression")
+
+    def wrap(self, owner, name, phase):
+        method = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.totals[phase] += time.perf_counter() - start
+
+        setattr(owner, name, timed)
+
+    def phases(self):
+        totals = dict(self.totals)
+        totals["lockdown"] = totals.pop("finish_hour") - totals["reporters"]
+        step = totals.pop("step")
+        totals["movement"] = step - sum(totals[phase] for phase in PHASES if phase != "movement")
+        return totals
+
+
+def run_benchmark(params, engine, num_steps, seed):
+    """
+    Build one model and step it, in a fresh process so the peak RSS is this run's.
+    :return: a result record
+    """
+    start = time.perf_counter()
+    model = ENGINES[engine](seed=seed, **params)
+    construction = time.perf_counter() - start
+    timer = PhaseTimer(model)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        model.step()
+    elapsed = time.perf_counter() - start
+    return {"engine": engine, "n": params["n"], "width": params["width"], "height": params["height"],
+            "house_depth": params["house_depth"], "seed": seed, "steps": num_steps,
+            "construction_seconds": construction, "steps_per_second": num_steps / elapsed,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "phase_seconds": timer.phases(), "total_cases": model.total_cases}
+
+
+def environment():
+    """
+    :return: what the results depend on besides the configuration: commit, interpreter and NumPy
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def benchmark(sizes, house_depths, grid_scales, engines, num_steps, seed, output, max_object_size=None):
+    """
+    Run every combination of size, house depth, grid scale and engine, each in its own process, appending one JSON
+    line per run to output. A house depth of None scales it with the size, see scaled_params. The object engine is
+    left out of sizes above max_object_size.
+    :return: the result records
+    """
+    context = environment()
+    results = []
+    for n, house_depth, grid_scale, engine in itertools.product(sizes, house_depths, grid_scales, engines):
+        if engine == "object" and max_object_size is not None and n > max_object_size:
+            print(f"{engine:>6} n={n:<7} skipped, above --max-object-size {max_object_size}")
+            continue
+        params = scaled_params(n, house_depth, grid_scale)
+        with multiprocessing.Pool(1) as pool:
+            result = dict(pool.apply(run_benchmark, (params, engine, num_steps, seed)), **context)
+        results.append(result)
+        with open(output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+        print(f"{engine:>6} n={n:<7} grid={params['width']:<4} depth={params['house_depth']:<2} "
+              f"build {result['construction_seconds']:.2f}s  {result['steps_per_second']:.1f} steps/s  "
+              f"{result['peak_rss_mb']:.0f} MB")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time PandemicModel construction and stepping across town sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[400, 2000, 10000, 100000])
+    parser.add_argument("--house-depths", type=int, nargs="+", default=[None],
+                        help="fixed house depths to try; by default the depth grows with the size")
+    parser.add_argument("--grid-scales", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("--max-object-size", type=int, default=20000,
+                        help="largest size the object engine is run at")
+    parser.add_argument("--steps", type=int, default=24 * 7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmarks.jsonl")
+    args = parser.parse_args()
+    benchmark(args.sizes, args.house_depths, args.grid_scales, args.engines, args.steps, args.seed, args.output,
+              args.max_object_size)
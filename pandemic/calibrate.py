@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from models import PandemicModel
+from sweep import REPORTERS, job_seed
+
+# Uniform prior bounds of the parameters fitted by default
+PRIORS = {"infection_probability": (0.0, 0.5), "asymptomatic_probability": (0.0, 1.0),
+          "lockdown_threshold": (0.0, 0.2), "liftlockdown_threshold": (0.0, 0.05)}
+
+
+def candidate_rng(seed, generation, index):
+    """
+    Generator for drawing one candidate, independent of the model seed job_seed(seed, generation, index) it is run
+    with. Candidates only depend on their position, so a calibration is the same on any number of processes.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(generation, index)).spawn(1)[0])
+
+
+def run_candidate(job):
+    """
+    Run one candidate against the target, abandoning it as soon as it can no longer be within tolerance. The sum of
+    squared errors of each reporter only grows as the run goes on, so once it is over the budget the tolerance
+    allows for the whole target the candidate is rejected whatever happens next.
+    :return: the candidate's index, its distance (inf if it was abandoned) and the hours it was run for
+    """
+    index, model_class, params, seed, columns, rows, target, scale, tolerance, check_every = job
+    model = model_class(seed=seed, **params)
+    series = [model.datacollector.model_vars[x] for x in columns]
+    budget = (tolerance * scale) ** 2 * len(rows)
+    sse = np.zeros(len(columns))
+    compared = 0
+    for hour in range(rows[-1] + 1):
+        model.step()
+        if (hour + 1) % check_every and hour != rows[-1]:
+            continue
+        upto = np.searchsorted(rows, hour, side="right")
+        simulated = np.array([[values[row] for row in rows[compared:upto]] for values in series]).T
+        sse += ((simulated - target[compared:upto]) ** 2).sum(axis=0)
+        compared = upto
+        if (sse > budget).any():
+            return index, np.inf, hour + 1
+    return index, float(np.max(np.sqrt(sse / len(rows)) / scale)), rows[-1] + 1
+
+
+def calibrate(target, base_params, priors=None, n_particles=100, generations=4, tolerances=None, quantile=0.5,
+              processes=None, seed=0, model_class=PandemicModel, check_every=24, max_simulations=10000):
+    """
+    Fit model parameters to target curves by ABC-SMC, running candidates on a process pool.
+
+    target is a frame with Infected and/or Total_Cases columns, indexed like the reporter frames sweep returns (row
+    i is the reporters after i + 1 hours); it may have only some rows, such as one a day. A candidate's distance is
+    the largest, over the target's columns, root mean square error divided by that column's peak. Each generation
+    accepts n_particles candidates within its tolerance, the first generation drawing from the uniform priors and
+    the later ones perturbing particles of the one before with a Gaussian kernel of twice their weighted
+    covariance. Tolerances default to infinity and then the given quantile of the last generation's distances; a
+    single tolerance makes it plain ABC rejection. Every check_every hours a candidate's partial trajectory is
+    compared to the target and the run is abandoned once it cannot be within tolerance.
+
+    A generation that has not accepted enough candidates after max_simulations runs ends the calibration.
+    :return: a frame per generation of the accepted parameters with their weight and distance, with the tolerance,
+    the number of runs and the fraction of simulated hours saved by abandoning runs in frame.attrs
+    """
+    priors = PRIORS if priors is None else priors
+    names = list(priors)
+    low, high = np.array([priors[x] for x in names], dtype=np.float64).T
+    columns = [x for x in REPORTERS if x in target.columns]
+    if not columns:
+        raise ValueError("The target has none of the reporters " + ", ".join(REPORTERS))
+    rows = target.index.to_numpy(dtype=np.int64)
+    values = target[columns].to_numpy(dtype=np.float64)
+    scale = np.maximum(np.abs(values).max(axis=0), 1.0)
+    if tolerances is not None:
+        generations = len(tolerances)
+    batch = 4 * (processes or os.cpu_count())
+
+    def propose(generation, index, particles, weights, cov):
+        rng = candidate_rng(seed, generation, index)
+        if particles is None:
+            return rng.uniform(low, high)
+        while True:
+            theta = rng.multivariate_normal(particles[rng.choice(len(particles), p=weights)], cov)
+            if ((theta >= low) & (theta <= high)).all():
+                return theta
+
+    populations = []
+    particles = weights = cov = None
+    with multiprocessing.Pool(processes) as pool:
+        for generation in range(generations):
+            if tolerances is not None:
+                tolerance = tolerances[generation]
+            else:
+                tolerance = np.inf if particles is None else float(np.quantile(populations[-1]["distance"], quantile))
+            accepted, distances = [], []
+            simulations = hours = 0
+            with tqdm(total=n_particles, desc=f"Generation {generation}") as progress:
+                while len(accepted) < n_particles and simulations < max_simulations:
+                    candidates = [propose(generation, simulations + i, particles, weights, cov)
+                                  for i in range(batch)]
+                    jobs = [(i, model_class, dict(base_params, **dict(zip(names, theta.tolist()))),
+                             job_seed(seed, generation, simulations + i), columns, rows, values, scale, tolerance,
+                             check_every) for i, theta in enumerate(candidates)]
+                    # In candidate order, so the accepted ones do not depend on the batch size
+                    for i, distance, simulated in pool.imap(run_candidate, jobs):
+                        hours += simulated
+                        if distance <= tolerance and len(accepted) < n_particles:
+                            accepted.append(candidates[i])
+                            distances.append(distance)
+                            progress.update()
+                    simulations += batch
+            if len(accepted) < n_particles:
+                break
+
+            theta = np.array(accepted)
+            if particles is None:
+                new_weights = np.ones(len(theta))
+            else:
+                # Uniform priors, so a particle's weight is one over the density it was proposed with
+                diff = theta[:, None, :] - particles[None, :, :]
+                distance = np.einsum("ijk,kl,ijl->ij", diff, np.linalg.inv(cov), diff)
+                new_weights = 1 / (np.exp(-0.5 * distance) @ weights)
+            particles, weights = theta, new_weights / new_weights.sum()
+            # Jittered so a population that has collapsed onto one value still has a usable kernel
+            cov = 2 * np.atleast_2d(np.cov(particles.T, aweights=weights)) + np.diag(((high - low) * 1e-6) ** 2)
+
+            frame = pd.DataFrame(particles, columns=names)
+            frame["weight"] = weights
+            frame["distance"] = distances
+            frame.attrs["tolerance"] = tolerance
+            frame.attrs["simulations"] = simulations
+            frame.attrs["saved"] = 1 - hours / (simulations * (rows[-1] + 1))
+            populations.append(frame)
+    return populations
+
+
+if __name__ == "__main__":
+    from array_model import ArrayPandemicModel
+
+    base_params = dict(n=400, width=50, height=50, masked_percentage=0.3, asymptomatic_probability=0.2,
+                       infection_length=10, infection_probability=0.12, time_till_symptoms=5,
+                       quarantine_length=14, immunity_length=50, n_workplaces=25, n_shops=5, n_schools=2,
+                       n_churches=2, n_couples=150, couples_with_kids_percentage=0.7,
+                       initial_infected_percentage=0.005, house_depth=4, lockdown_threshold=0.05,
+                       liftlockdown_threshold=0.01)
+    num_days = 90
+    # A known run stands in for observed daily cases
+    model = ArrayPandemicModel(seed=1, **base_params)
+    for _ in range(num_days * 24):
+        model.step()
+    observed = model.datacollector.get_model_vars_dataframe()[["Infected", "Total_Cases"]].iloc[23::24]
+
+    populations = calibrate(observed, base_params, n_particles=50, model_class=ArrayPandemicModel)
+    for generation, frame in enumerate(populations):
+        print(f"Generation {generation}: tolerance {frame.attrs['tolerance']:.3f}, "
+              f"{frame.attrs['simulations']} runs, {frame.attrs['saved']:.0%} of simulated hours saved")
+    posterior = populations[-1]
+    for name in PRIORS:
+        mean = np.average(posterior[name], weights=posterior["weight"])
+        print(f"{name}: {mean:.3f} (true {base_params[name]})")
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from array_model import ArrayPandemicModel
+from transmission import attribute_sources
+
+VENUE_TYPES = ["House", "School", "Workplace", "Shop", "Church", "Other"]
+HOUSE, SCHOOL, WORKPLACE, SHOP, CHURCH, OTHER = range(len(VENUE_TYPES))
+
+
+def cell_types(model):
+    """
+    :return: venue type of every flat cell (x * height + y) of the model's grid
+    """
+    height = model.grid.height
+    types = np.full(model.grid.width * height, OTHER, dtype=np.int8)
+    if isinstance(model, ArrayPandemicModel):
+        types[model.house] = HOUSE
+    else:
+        types[[x * height + y for x, y in (agent.house for agent in model.schedule.agents)]] = HOUSE
+    for venue_type, cells in [(SCHOOL, model.schools), (WORKPLACE, model.workplaces), (SHOP, model.shops),
+                              (CHURCH, model.churches)]:
+        types[[x * height + y for x, y in cells]] = venue_type
+    return types
+
+
+class ContactLog:
+    """
+    Who infected whom, where and when, streamed to an append-only Arrow IPC file.
+
+    Every infection is a row of hour, source id, target id, venue (the flat cell it happened in) and venue type,
+    buffered in preallocated typed columns and written a chunk at a time like StreamingSink. The model only works
+    out the chance of each infection, so the source is drawn afterwards in proportion to each cellmate's share of
+    it, with the log's own generator so that logging does not change the run. Exposure person-hours (susceptible
+    people with a nonzero chance of infection) are counted per venue type alongside and written next to the log on
+    close. Hours skipped by ArrayPandemicModel.fast_forward are not counted.
+    """
+
+    def __init__(self, path, cell_types, seed=None, chunk_size=4096):
+        self.path = path
+        self.cell_types = cell_types
+        self.rng = np.random.default_rng(seed)
+        self.chunk_size = chunk_size
+        self.columns = {"Hour": np.empty(chunk_size, dtype=np.int64), "Source": np.empty(chunk_size, dtype=np.int64),
+                        "Target": np.empty(chunk_size, dtype=np.int64), "Venue": np.empty(chunk_size, dtype=np.int64),
+                        "VenueType": np.empty(chunk_size, dtype=np.int8)}
+        self.rows = 0
+        self.writer = None
+        self.exposures = np.zeros(len(VENUE_TYPES), dtype=np.int64)
+
+    def record(self, hour, sources, targets, probability, infected, infection_probability):
+        """
+        Log one hour of transmission. sources and targets are (ids, cells, keys, modifiers) as passed to
+        infection_chance, probability is each target's chance and infected marks the targets that were infected.
+        :return:
+        """
+        exposed = probability > 0
+        self.exposures += np.bincount(self.cell_types[targets[1][exposed]], minlength=len(VENUE_TYPES))
+        if not infected.any():
+            return
+        source = attribute_sources(self.rng, *sources[1:], *(column[infected] for column in targets[1:]),
+                                   infection_probability)
+        venues = targets[1][infected]
+        self.append(hour, sources[0][source], targets[0][infected], venues, self.cell_types[venues])
+
+    def append(self, hour, source, target, venue, venue_type):
+        start = 0
+        while start < len(source):
+            stop = min(start + self.chunk_size - self.rows, len(source))
+            rows = slice(self.rows, self.rows + stop - start)
+            self.columns["Hour"][rows] = hour
+            self.columns["Source"][rows] = source[start:stop]
+            self.columns["Target"][rows] = target[start:stop]
+            self.columns["Venue"][rows] = venue[start:stop]
+            self.columns["VenueType"][rows] = venue_type[start:stop]
+            self.rows += stop - start
+            start = stop
+            if self.rows == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.record_batch([pa.array(column[:self.rows]) for column in self.columns.values()],
+                                names=list(self.columns))
+        if self.writer is None:
+            self.writer = pa.ipc.new_stream(self.path, batch.schema)
+        self.writer.write_batch(batch)
+        self.rows = 0
+
+    def close(self):
+        """
+        Write out the last partial chunk, close the file and save the exposure counts to path + ".exposures.npy".
+        """
+        if self.writer is None:
+            # Nobody was infected, but readers still expect a (empty) stream
+            self.writer = pa.ipc.new_stream(self.path, pa.schema([(name, pa.from_numpy_dtype(column.dtype))
+                                                                  for name, column in self.columns.items()]))
+        self.flush()
+        self.writer.close()
+        self.writer = None
+        np.save(self.path + ".exposures.npy", self.exposures)
+
+
+def log_contacts(model, path, seed=None, chunk_size=4096):
+    """
+    Start logging the model's infections to path.
+    :return: the log, which should be closed once the run is over
+    """
+    model.contact_log = ContactLog(path, cell_types(model), seed, chunk_size)
+    return model.contact_log
+
+
+def read_contacts(path):
+    """
+    :return: the infections logged to path as a DataFrame, and the exposure person-hours per venue type
+    """
+    with pa.ipc.open_stream(path) as reader:
+        events = reader.read_all().to_pandas()
+    return events, np.load(path + ".exposures.npy")
+
+
+def reproduction_numbers(events):
+    """
+    Case reproduction number by day: the mean number of people infected by each person infected that day, counting
+    for every infection the people infected before that person's next infection. Only infections in the log count
+    as cases, and the last days are biased low as their cases were still infectious when the run ended.
+    :return: Series of R indexed by day of infection
+    """
+    hour = events["Hour"].to_numpy()
+    source = events["Source"].to_numpy()
+    target = events["Target"].to_numpy()
+    span = int(hour.max()) + 1 if len(hour) else 1
+    order = np.argsort(target * span + hour, kind="stable")
+    keys = (target * span + hour)[order]
+    # The source's latest infection before each event, if the log has one
+    latest = np.searchsorted(keys, source * span + hour, side="left") - 1
+    found = latest >= 0
+    found[found] = target[order[latest[found]]] == source[found]
+    secondary = np.bincount(order[latest[found]], minlength=len(events))
+    day = hour // 24
+    counts = np.bincount(day)
+    days = np.flatnonzero(counts)
+    return pd.Series(np.bincount(day, weights=secondary)[days] / counts[days], index=pd.Index(days, name="Day"),
+                     name="R")
+
+
+def attack_rates(events, exposures):
+    """
+    :return: frame of infections, exposure person-hours and infections per exposure person-hour by venue type
+    """
+    infections = np.bincount(events["VenueType"].to_numpy(), minlength=len(VENUE_TYPES))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rate = infections / exposures
+    return pd.DataFrame({"Infections": infections, "Exposures": exposures, "AttackRate": rate},
+                        index=pd.Index(VENUE_TYPES, name="VenueType"))
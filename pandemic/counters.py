@@ -0,0 +1,56 @@
+from bisect import bisect_left
+
+import numpy as np
+
+SUSCEPTIBLE, INFECTED, RECOVERED, QUARANTINED, DEAD = range(5)
+COMPARTMENTS = ["Susceptible", "Infected", "Recovered", "Quarantined", "Dead"]
+GROUPS = ["Unmasked", "Masked"]
+# Upper bounds of the age bands, the same bands that set a person's death probability
+AGE_BANDS = [20, 40, 60]
+
+
+def age_band(age):
+    return bisect_left(AGE_BANDS, age)
+
+
+class CompartmentCounters:
+    """
+    Live head counts per compartment, split by mask group and age band.
+
+    Susceptible, Infected and Recovered partition the living population, Quarantined overlaps them and Dead only
+    grows. The counts are updated at every state transition, so reading them never needs a pass over the agents.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros((len(COMPARTMENTS), len(GROUPS), len(AGE_BANDS) + 1), dtype=np.int64)
+
+    def add(self, compartment, group, band, amount=1):
+        self.counts[compartment, group, band] += amount
+
+    def move(self, source, destination, group, band):
+        self.counts[source, group, band] -= 1
+        self.counts[destination, group, band] += 1
+
+    def add_many(self, compartment, groups, bands, amount=1):
+        """
+        Vectorised add for arrays of groups and bands, one entry per person.
+        """
+        np.add.at(self.counts[compartment], (groups, bands), amount)
+
+    def move_many(self, source, destination, groups, bands):
+        self.add_many(source, groups, bands, -1)
+        self.add_many(destination, groups, bands)
+
+    def total(self, compartment):
+        return int(self.counts[compartment].sum())
+
+    def count(self, compartment, group=None, band=None):
+        """
+        :return: the number of people in compartment, optionally only those in one mask group and/or age band
+        """
+        counts = self.counts[compartment]
+        if group is not None:
+            counts = counts[group:group + 1]
+        if band is not None:
+            counts = counts[:, band]
+        return int(counts.sum())
@@ -0,0 +1,79 @@
+var DeltaGridModule = function(canvas_width, canvas_height, grid_width, grid_height) {
+	// Create the element
+	// ------------------
+
+	var canvas_tag = `<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`;
+	var parent_div_tag = '<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>';
+
+	var canvas = $(canvas_tag)[0];
+	var parent = $(parent_div_tag)[0];
+	$("#elements").append(parent);
+	parent.append(canvas);
+
+	var context = canvas.getContext("2d");
+	var canvasDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height, context, null);
+	var cellWidth = Math.floor(canvas_width / grid_width);
+	var cellHeight = Math.floor(canvas_height / grid_height);
+
+	// What is on screen: agent id -> [x, y, shape, color, layer, r, filled], and the agent ids in each cell
+	var agents = new Map();
+	var cells = new Map();
+
+	var cellKey = function(x, y) {
+		return x * grid_height + y;
+	};
+
+	var lift = function(id, dirty) {
+		var agent = agents.get(id);
+		if (agent === undefined)
+			return;
+		var key = cellKey(agent[0], agent[1]);
+		cells.get(key).delete(id);
+		dirty.add(key);
+		agents.delete(id);
+	};
+
+	// Clear one cell and draw the agents in it again, lowest layer first
+	var drawCell = function(key) {
+		var x = Math.floor(key / grid_height);
+		var y = grid_height - key % grid_height - 1;
+		context.clearRect(x * cellWidth, y * cellHeight, cellWidth, cellHeight);
+		var ids = cells.get(key);
+		if (ids === undefined)
+			return;
+		var drawn = Array.from(ids, id => agents.get(id)).sort((a, b) => a[4] - b[4]);
+		for (var agent of drawn) {
+			if (agent[2] == "rect")
+				canvasDraw.drawRectangle(x, y, agent[5], agent[5], [agent[3]], agent[3], agent[6]);
+			else
+				canvasDraw.drawCircle(x, y, agent[5], [agent[3]], agent[3], agent[6]);
+		}
+	};
+
+	this.render = function(data) {
+		if (data.reset)
+			this.reset();
+		var dirty = new Set();
+		for (var id of data.removed)
+			lift(id, dirty);
+		for (var change of data.changed) {
+			var id = change[0];
+			lift(id, dirty);
+			var agent = change.slice(1);
+			var key = cellKey(agent[0], agent[1]);
+			agents.set(id, agent);
+			if (!cells.has(key))
+				cells.set(key, new Set());
+			cells.get(key).add(id);
+			dirty.add(key);
+		}
+		dirty.forEach(drawCell);
+	};
+
+	this.reset = function() {
+		agents.clear();
+		cells.clear();
+		context.clearRect(0, 0, canvas_width, canvas_height);
+	};
+
+};
@@ -0,0 +1,68 @@
+from mesa.visualization.ModularVisualization import VisualizationElement
+
+
+class DeltaGrid(VisualizationElement):
+    """
+    Canvas grid that only sends the agents whose position or look changed since the last frame.
+
+    The browser keeps every agent on screen and repaints just the cells that changed. state_method gives what an
+    agent's portrayal depends on besides its position; portrayal_method is only called when that or the position
+    changes, and on every frame when no state_method is given. Circles and rects are drawn, with Color, Layer,
+    r (a fraction of the cell, also the side of a rect) and Filled taken from the portrayal.
+    """
+    package_includes = ["GridDraw.js"]
+    local_includes = ["delta_grid.js"]
+
+    def __init__(self, portrayal_method, grid_width, grid_height, canvas_width=500, canvas_height=500,
+                 state_method=None):
+        self.portrayal_method = portrayal_method
+        self.state_method = state_method
+        self.js_code = (f"elements.push(new DeltaGridModule({canvas_width}, {canvas_height}, {grid_width}, "
+                        f"{grid_height}));")
+        self.model = None
+        self.shown = {}
+
+    def render(self, model):
+        reset = model is not self.model
+        if reset:
+            # The server built a new model, so the browser starts from an empty canvas
+            self.model = model
+            self.shown = {}
+        changed = []
+        current = {}
+        for agent in model.schedule.agents:
+            if agent.pos is None:
+                continue
+            if self.state_method is not None:
+                state = (agent.pos, self.state_method(agent))
+                row = None if self.shown.get(agent.unique_id) == state else self.portray(agent)
+            else:
+                row = self.portray(agent)
+                state = tuple(row)
+                row = None if self.shown.get(agent.unique_id) == state else row
+            current[agent.unique_id] = state
+            if row is not None:
+                changed.append([agent.unique_id] + row)
+        removed = [unique_id for unique_id in self.shown if unique_id not in current]
+        self.shown = current
+        return {"reset": reset, "changed": changed, "removed": removed}
+
+    def portray(self, agent):
+        portrayal = self.portrayal_method(agent)
+        return [agent.pos[0], agent.pos[1], portrayal.get("Shape", "circle"), portrayal["Color"],
+                portrayal.get("Layer", 0), portrayal.get("r", 0.5), portrayal.get("Filled", "true") in [True, "true"]]
+
+
+def batched(model_class, steps_per_frame):
+    """
+    Subclass of model_class whose step runs steps_per_frame steps, so the server renders once per batch.
+    """
+    class BatchedModel(model_class):
+        def step(self):
+            for _ in range(steps_per_frame):
+                if not self.running:
+                    break
+                super().step()
+
+    BatchedModel.__name__ = model_class.__name__
+    return BatchedModel
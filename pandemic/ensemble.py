@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+import progression
+from array_model import ArrayPandemicModel
+from counters import SUSCEPTIBLE, INFECTED, RECOVERED
+from schedules import HOME
+from sweep import REPORTERS, job_seed
+from transmission import infection_chance
+
+
+class EnsembleModel:
+    """
+    Many replicates of one pandemic configuration advanced in lock step.
+
+    Each replicate is its own town and population, drawn like a fresh ArrayPandemicModel with its own seed, but the
+    state of all of them lives in (replicates, people) arrays, padded with dead people where populations differ in
+    size. An hour of the whole ensemble is the same handful of array operations as an hour of one ArrayPandemicModel,
+    and transmission runs once over all replicates by giving every town its own range of cell indices; the disease
+    timers are the ones in progression, which ArrayPandemicModel runs too. Lockdowns and compartment counts
+    (replicates, compartments, groups, age bands) are per replicate. Reporters are written into a preallocated
+    (hours, replicates, reporters) array.
+    """
+
+    def __init__(self, replicates, seed=0, **params):
+        towns = [ArrayPandemicModel(seed=job_seed(seed, 0, replicate), **params) for replicate in range(replicates)]
+        self.replicates = replicates
+        self.n_agents = max(town.n_agents for town in towns)
+        self.n_cells = towns[0].n_cells
+        self.infection_length = params["infection_length"]
+        self.infection_probability = params["infection_probability"]
+        self.time_till_symptoms = params["time_till_symptoms"]
+        self.quarantine_length = params["quarantine_length"]
+        self.immunity_length = params["immunity_length"]
+        self.asymptomatic_probability = params["asymptomatic_probability"]
+        self.lockdown_threshold = params["lockdown_threshold"]
+        self.liftlockdown_threshold = params["liftlockdown_threshold"]
+        self.rng = np.random.default_rng(seed)
+        self.hours = 0
+        self.time = 0
+        self.age = 0
+
+        # Schedules hold flat cells rather than venue ids, so the towns' tables can be stacked into one
+        tables, offsets = [], []
+        for town in towns:
+            offsets.append(sum(len(table) for table in tables))
+            table = town.schedule_table.table[:town.schedule_table.n_rows]
+            tables.append(np.where(table == HOME, HOME, town.schedule_table.venue_cells[table]))
+        self.cell_table = np.concatenate(tables)
+        self.home_row = towns[0].schedule_table.home_row
+
+        def stack(name, fill=0, offset=None):
+            column = np.full((replicates, self.n_agents), fill, dtype=getattr(towns[0], name).dtype)
+            for replicate, town in enumerate(towns):
+                column[replicate, :town.n_agents] = getattr(town, name) + (0 if offset is None else offset[replicate])
+            return column
+
+        self.ages = stack("ages")
+        self.house = stack("house")
+        self.position = stack("position")
+        self.normal_schedule = stack("normal_schedule", self.home_row, offsets)
+        self.lockdown_schedule = stack("lockdown_schedule", self.home_row, offsets)
+        self.infection_modifier = stack("infection_modifier", 1.0)
+        self.death_probability = stack("death_probability")
+        self.alive = stack("alive", False)
+        self.infected = stack("infected", False)
+        self.immune = stack("immune", False)
+        self.quarantined = stack("quarantined", False)
+        self.asymptomatic = stack("asymptomatic", False)
+        self.time_infected = stack("time_infected")
+        self.time_recovered = stack("time_recovered")
+        self.time_quarantined = stack("time_quarantined")
+        self.death_attempt_day = stack("death_attempt_day")
+        self.group = stack("group")
+        self.band = stack("band")
+        self.replicate = np.repeat(np.arange(replicates)[:, None], self.n_agents, axis=1)
+        self.counts = np.stack([town.counters.counts for town in towns])
+        self.cell_offset = np.arange(replicates)[:, None] * self.n_cells
+
+        self.lockdown_active = np.zeros(replicates, dtype=bool)
+        self.dead_people = np.zeros(replicates, dtype=np.int64)
+        self.total_cases = np.array([town.total_cases for town in towns], dtype=np.int64)
+        self.history = np.empty((24, replicates, len(REPORTERS)), dtype=np.int64)
+
+    def step(self):
+        day, hour = self.age % 7, self.time
+        self.transmit(day, hour)
+        self.progress_infections()
+        self.progress_immunity()
+        self.progress_quarantine()
+        self.position = self.active_location(day, hour)
+        self.attempt_deaths()
+        self.finish_hour()
+
+    def run(self, num_steps):
+        for _ in range(num_steps):
+            self.step()
+
+    def active_location(self, day, hour):
+        """
+        Resolve where everyone is scheduled to be, with the lockdown flag of their own replicate. day is a scalar or
+        an array of days per person.
+        :return: (replicates, people) array of flat cell indices within each town
+        """
+        schedule = np.where(self.lockdown_active[:, None], self.lockdown_schedule, self.normal_schedule)
+        rows = np.where(self.quarantined, self.home_row, schedule)
+        cells = self.cell_table[rows, day, hour]
+        return np.where(cells == HOME, self.house, cells)
+
+    def transmit(self, day, hour):
+        """
+        The transmission of ArrayPandemicModel.transmit for every replicate at once; cells of different towns never
+        meet because each replicate's cells are offset by its index times the town size.
+        :return:
+        """
+        sources = np.flatnonzero(self.infected)
+        targets = np.flatnonzero(self.alive & ~self.infected & ~self.immune)
+        if len(sources) == 0 or len(targets) == 0:
+            return
+        previous_hour = (hour - 1) % 24
+        cells = (self.position + self.cell_offset).ravel()
+        source_keys = (self.active_location(day, previous_hour) + self.cell_offset).ravel()
+        target_keys = (self.active_location(self.ages % 7, previous_hour) + self.cell_offset).ravel()
+        modifiers = self.infection_modifier.ravel()
+        probability = infection_chance(cells[sources], source_keys[sources], modifiers[sources],
+                                       cells[targets], target_keys[targets], modifiers[targets],
+                                       self.infection_probability, self.replicates * self.n_cells)
+        self.infect(targets[self.rng.random(len(targets)) < probability])
+
+    def infect(self, indices):
+        """
+        Infect people by flat index into the (replicates, people) arrays.
+        :return:
+        """
+        self.move_counts(SUSCEPTIBLE, INFECTED, np.unravel_index(indices, self.infected.shape))
+        self.infected.ravel()[indices] = True
+        self.time_infected.ravel()[indices] = 0
+        self.asymptomatic.ravel()[indices] = self.rng.random(len(indices)) < self.asymptomatic_probability
+        self.death_attempt_day.ravel()[indices] = self.rng.integers(0, self.infection_length, len(indices))
+        self.total_cases += np.bincount(indices // self.n_agents, minlength=self.replicates)
+
+    def progress_infections(self):
+        progression.progress_infections(self, self.rng)
+
+    def progress_immunity(self):
+        progression.progress_immunity(self)
+
+    def progress_quarantine(self):
+        progression.progress_quarantine(self)
+
+    def attempt_deaths(self):
+        self.dead_people += progression.attempt_deaths(self, self.rng).sum(axis=1)
+
+    def add_counts(self, compartment, people, amount=1):
+        np.add.at(self.counts[:, compartment], (self.replicate[people], self.group[people], self.band[people]),
+                  amount)
+
+    def move_counts(self, source, destination, people):
+        self.add_counts(source, people, -1)
+        self.add_counts(destination, people)
+
+    def count(self, compartment):
+        """
+        :return: (replicates,) array of the number of people in compartment in every replicate
+        """
+        return self.counts[:, compartment].sum(axis=(1, 2))
+
+    def finish_hour(self):
+        self.hours += 1
+        self.time = (self.time + 1) % 24
+        if self.time == 0:
+            self.age += 1
+        infected = self.count(INFECTED)
+        infected_fraction = infected / (self.count(SUSCEPTIBLE) + infected + self.count(RECOVERED))
+        self.lockdown_active = ((self.lockdown_active | (infected_fraction > self.lockdown_threshold))
+                                & ~(infected_fraction < self.liftlockdown_threshold))
+        if self.hours > len(self.history):
+            self.history = np.concatenate([self.history, np.empty_like(self.history)])
+        self.history[self.hours - 1] = np.stack([self.dead_people, infected, self.total_cases], axis=1)
+
+    def series(self, reporter):
+        """
+        :return: (hours, replicates) array of one reporter for every replicate
+        """
+        return self.history[:self.hours, :, REPORTERS.index(reporter)]
+
+    def summary(self, quantiles=(0.05, 0.5, 0.95)):
+        """
+        Ensemble statistics per hour, computed along the replicate axis in one go.
+        :return: frame with the mean of every reporter and a {reporter}_q{percent} column for each quantile
+        """
+        history = self.history[:self.hours]
+        columns = dict(zip(REPORTERS, history.mean(axis=1).T))
+        for quantile, values in zip(quantiles, np.quantile(history, quantiles, axis=1)):
+            for idx, x in enumerate(REPORTERS):
+                columns[f"{x}_q{round(quantile * 100):02d}"] = values[:, idx]
+        return pd.DataFrame(columns)
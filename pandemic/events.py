@@ -0,0 +1,28 @@
+class EventQueue:
+    """
+    Calendar queue of agent events, bucketed by the model hour in which they fall due.
+
+    An event is an agent and the name of the method to call on it, so the queue only holds plain data and nothing
+    is done for agents without anything due.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def schedule(self, hour, agent, event):
+        self.buckets.setdefault(hour, []).append((agent, event))
+
+    def due(self, hour):
+        """
+        Yield the events due in hour in the order they were scheduled, including any scheduled for the same hour
+        while the bucket is being processed, then drop the bucket.
+        """
+        bucket = self.buckets.get(hour, [])
+        i = 0
+        while i < len(bucket):
+            yield bucket[i]
+            i += 1
+        self.buckets.pop(hour, None)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
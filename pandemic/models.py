@@ -1,25 +1,33 @@
-import random
+import numpy as np
 
 from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
-from mesa.time import SimultaneousActivation, RandomActivation
+from mesa.time import RandomActivation
 from mesa import Model
 from agents import *
+from counters import *
+from events import EventQueue
+from population import CellPool, house_cells, unused_cells
+from schedules import ScheduleTable
+from transmission import infection_chance
 
 
 class PandemicModel(Model):
 
     def __init__(self, n, couples_with_kids_percentage, n_couples, width, height, masked_percentage, infection_length,
                  infection_probability, time_till_symptoms, quarantine_length, immunity_length, n_workplaces, n_shops,
-                 n_schools, n_churches, initial_infected_percentage, house_depth, asymptomatic_probability, lockdown_threshold, liftlockdown_threshold):
+                 n_schools, n_churches, initial_infected_percentage, house_depth, asymptomatic_probability, lockdown_threshold, liftlockdown_threshold, seed=None, debug_counters=False):
 
         self.lockdown_active = False
+        self.debug_counters = debug_counters
+        self.counters = CompartmentCounters()
+        self.events = EventQueue()
+        self.contact_log = None
+        self.hours = 0
         self.n = n
-        self.grid = MultiGrid(width, height, True)
+        self.grid = self.create_grid(width, height)
         self.schedule = RandomActivation(self)
-        self.datacollector = DataCollector(
-            model_reporters={"Dead": self.get_dead_amount, "Infected": self.get_infected_amount,"Total_Cases": self.get_total_cases},
-        )
+        self.datacollector = self.create_datacollector()
         self.asymptomatic_probability = asymptomatic_probability
         self.masked_percentage = masked_percentage
         self.infection_length = infection_length
@@ -32,29 +40,80 @@ class PandemicModel(Model):
         self.time = 0
         self.lockdown_threshold = lockdown_threshold
         self.liftlockdown_threshold = liftlockdown_threshold
-        self.empty_house_cells = self.generate_empty_house_cells(house_depth)
-        if (n - (n_couples * 2)) + n_couples > len(self.empty_house_cells):
-            raise ValueError("Too many people in the model")
-        self.unused_cells = [x for x in self.grid.empties if x not in self.empty_house_cells]
-        self.schools, self.workplaces, self.shops, self.churches = self.generate_features(n_schools, n_workplaces, n_shops, n_churches)
+        self.build_town(n, n_couples, house_depth, n_schools, n_workplaces, n_shops, n_churches)
         self.create_agents(couples_with_kids_percentage, n_couples, n - n_couples * 2)
         self.infect_agents(initial_infected_percentage)
         self.dead_people = 0
         self.running = True
 
     def step(self):
+        self.transmit()
+        self.process_events()
         self.schedule.step()
+        self.finish_hour()
+
+    def create_grid(self, width, height):
+        return MultiGrid(width, height, True)
+
+    def create_datacollector(self):
+        return DataCollector(
+            model_reporters={"Dead": self.get_dead_amount, "Infected": self.get_infected_amount,"Total_Cases": self.get_total_cases},
+        )
+
+    def process_events(self):
+        for agent, event in self.events.due(self.hours):
+            if agent.alive:
+                getattr(agent, event)()
+
+    def finish_hour(self):
+        self.hours += 1
         self.time = (self.time + 1) % 24
         if self.time == 0:
             self.age += 1
-        if self.get_infected_amount() / len(self.schedule.agents) > self.lockdown_threshold:
+        infected_fraction = self.get_infected_amount() / self.get_alive_amount()
+        if infected_fraction > self.lockdown_threshold:
             self.lockdown()
-            self.lockdown_active = True
-        if self.get_infected_amount() / len(self.schedule.agents) < self.liftlockdown_threshold and self.lockdown_active:
+        if infected_fraction < self.liftlockdown_threshold and self.lockdown_active:
             self.lift_lockdown()
-            self.lockdown_active = False
+        if self.debug_counters:
+            self.check_counters()
         self.datacollector.collect(self)
 
+    def transmit(self):
+        """
+        Transmission stage: groups everyone by their current cell once and infects susceptible people from the
+        infectious pressure of the infected people sharing their cell. Every infected cellmate whose scheduled
+        position last hour differs from the susceptible person's makes one attempt, succeeding with probability
+        infection_probability * (its infection_modifier * the susceptible person's infection_modifier).
+        :return:
+        """
+        sources = [agent for agent in self.schedule.agents if agent.infected]
+        source_cells = {agent.pos for agent in sources}
+        targets = [agent for agent in self.schedule.agents
+                   if not agent.infected and not agent.immune and agent.pos in source_cells]
+        if not targets:
+            return
+        height = self.grid.height
+        previous_hour = self.time - 1
+        source = (np.array([agent.unique_id for agent in sources]),
+                  np.array([agent.pos[0] * height + agent.pos[1] for agent in sources]),
+                  np.array([x * height + y for x, y in
+                            (agent.scheduled_position(self.age % 7, previous_hour) for agent in sources)]),
+                  np.array([agent.infection_modifier for agent in sources]))
+        target = (np.array([agent.unique_id for agent in targets]),
+                  np.array([agent.pos[0] * height + agent.pos[1] for agent in targets]),
+                  np.array([x * height + y for x, y in
+                            (agent.scheduled_position(agent.age % 7, previous_hour) for agent in targets)]),
+                  np.array([agent.infection_modifier for agent in targets]))
+        probability = infection_chance(*source[1:], *target[1:], self.infection_probability, self.grid.width * height)
+        infected = np.zeros(len(targets), dtype=bool)
+        for idx, (agent, chance) in enumerate(zip(targets, probability)):
+            if self.random.random() < chance:
+                agent.infect()
+                infected[idx] = True
+        if self.contact_log is not None:
+            self.contact_log.record(self.hours, source, target, probability, infected, self.infection_probability)
+
     def create_agents(self, children_percentage, n_couples, n_single):
         type_dict = {"Masked": MaskedPerson, "Unmasked": UnmaskedPerson}
 
@@ -86,17 +145,25 @@ class PandemicModel(Model):
                 self.grid.place_agent(new_agent, couple_house)
 
 
-    def generate_empty_house_cells(self, depth=1):
-        empty_house_cells = []
-        for i in range(1, depth+1):
-            for x in [i-1, self.grid.width - i]:
-                for y in range(self.grid.height - i):
-                    empty_house_cells.append((x, y))
-            for y in [i-1, self.grid.height - i]:
-                for x in range(i, self.grid.width - (i + 1)):
-                    empty_house_cells.append((x, y))
+    def build_town(self, n, n_couples, house_depth, n_schools, n_workplaces, n_shops, n_churches):
+        """
+        Lay out the houses and venues. Cells are handed out from CellPools, which draw the same cells as popping
+        from lists without their linear cost. Venues are drawn from the other cells in x-major order, which only
+        needs the grid's size, so the array engine can build the same town without placing anyone on a grid.
+        :return:
+        """
+        cells = self.generate_empty_house_cells(house_depth)
+        if (n - (n_couples * 2)) + n_couples > len(cells):
+            raise ValueError("Too many people in the model")
+        self.empty_house_cells = CellPool(cells)
+        height = self.grid.height
+        unused = unused_cells(self.grid.width, height, self.empty_house_cells.cells)
+        self.unused_cells = CellPool(np.stack(np.divmod(unused, height), axis=1))
+        self.schools, self.workplaces, self.shops, self.churches = self.generate_features(n_schools, n_workplaces, n_shops, n_churches)
+        self.schedule_table = ScheduleTable(self.grid.height)
 
-        return empty_house_cells
+    def generate_empty_house_cells(self, depth=1):
+        return house_cells(self.grid.width, self.grid.height, depth)
 
     def assign_house_cell(self):
         return self.empty_house_cells.pop(self.random.randint(0, len(self.empty_house_cells) - 1))
@@ -115,27 +182,40 @@ class PandemicModel(Model):
         self.random.choice(self.schedule.agents).infect()
 
     def lockdown(self):
-        for agent in self.schedule.agents:
-            agent.active_schedule = agent.lockdown_schedule if not agent.quarantined else agent.quarantine_schedule
-            if agent.type == "Masked":
-                agent.mask_wear_rate = 1
-
+        # Schedules and mask wear are resolved from this flag when they are read, so this is constant time
+        self.lockdown_active = True
 
     def lift_lockdown(self):
-        for agent in self.schedule.agents:
-            agent.active_schedule = agent.normal_schedule if not agent.quarantined else agent.quarantine_schedule
+        self.lockdown_active = False
 
     def get_dead_amount(self):
         return self.dead_people
 
     def get_infected_amount(self):
-        return len([agent for agent in self.schedule.agents if agent.infected])
+        return self.counters.total(INFECTED)
 
     def get_uninfected_amount(self):
-        return len(self.schedule.agents) - self.get_infected_amount()
+        return self.get_alive_amount() - self.get_infected_amount()
 
     def get_alive_amount(self):
-        return len(self.schedule.agents)
+        return self.counters.total(SUSCEPTIBLE) + self.counters.total(INFECTED) + self.counters.total(RECOVERED)
+
+    def scan_compartments(self):
+        """
+        Count the living compartments the slow way, by looking at every agent.
+        :return: array shaped like the Susceptible to Quarantined rows of CompartmentCounters.counts
+        """
+        counts = np.zeros_like(self.counters.counts[:DEAD])
+        for agent in self.schedule.agents:
+            counts[(agent.compartment,) + agent.counter_key] += 1
+            if agent.quarantined:
+                counts[(QUARANTINED,) + agent.counter_key] += 1
+        return counts
+
+    def check_counters(self):
+        if not np.array_equal(self.scan_compartments(), self.counters.counts[:DEAD]) or \
+                self.counters.total(DEAD) != self.dead_people:
+            raise RuntimeError(f"Compartment counters do not match a full scan on day {self.age} at hour {self.time}")
 
     def get_total_cases(self):
         return self.total_cases
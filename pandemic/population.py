@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from schedules import ScheduleTable, generate_weekly_schedules
+
+POPULATION_VERSION = 1
+GENERATION_PARAMETERS = ["n", "couples_with_kids_percentage", "n_couples", "width", "height", "masked_percentage",
+                         "n_workplaces", "n_shops", "n_schools", "n_churches", "house_depth"]
+FEATURES = ["schools", "workplaces", "shops", "churches"]
+
+
+class CellPool:
+    """
+    A list of cells handed out one at a time by position, like list.pop(index), in O(log n) per pop.
+
+    The cells never move: a Fenwick tree over which of them are still in the pool finds the cell at a given
+    position among the remaining ones, so a model drawing the same indices gets the same cells as with a list.
+    The cells and the tree are kept in arrays rather than lists of tuples, so a pool of a large town's cells stays
+    small.
+    """
+
+    def __init__(self, cells):
+        self.cells = np.array(cells if isinstance(cells, np.ndarray) else list(cells), dtype=np.int64).reshape(-1, 2)
+        self.remaining = np.ones(len(self.cells), dtype=bool)
+        self.size = len(self.cells)
+        self.tree = np.arange(len(self.cells) + 1)
+        self.tree &= -self.tree
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (tuple(cell) for cell in self.cells[self.remaining].tolist())
+
+    def pop(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("pop index out of range")
+        # Walk down the tree to the last position whose prefix count is at most index
+        position, count = 0, index + 1
+        step = 1 << (len(self.cells).bit_length() - 1)
+        while step:
+            if position + step <= len(self.cells) and self.tree[position + step] < count:
+                position += step
+                count -= self.tree[position]
+            step >>= 1
+        i = position + 1
+        while i <= len(self.cells):
+            self.tree[i] -= 1
+            i += i & -i
+        self.remaining[position] = False
+        self.size -= 1
+        return tuple(self.cells[position].tolist())
+
+
+def house_cells(width, height, depth=1):
+    """
+    The house cells of a town: depth rings of cells around the edge of the grid, in the order they are drawn from.
+    """
+    cells = []
+    for i in range(1, depth + 1):
+        for x in [i - 1, width - i]:
+            for y in range(height - i):
+                cells.append((x, y))
+        for y in [i - 1, height - i]:
+            for x in range(i, width - (i + 1)):
+                cells.append((x, y))
+    return cells
+
+
+def unused_cells(width, height, houses):
+    """
+    The cells of a town that are not house cells, as flat indices (x * height + y) in increasing order.
+    :param houses: (cells, 2) array of the house cells
+    """
+    is_house = np.zeros(width * height, dtype=bool)
+    is_house[houses[:, 0] * height + houses[:, 1]] = True
+    return np.flatnonzero(~is_house)
+
+
+def build_population(seed, n, couples_with_kids_percentage, n_couples, width, height, masked_percentage, n_workplaces,
+                     n_shops, n_schools, n_churches, house_depth, **_):
+    """
+    Draw a town and its population with array operations: venues, households, ages, masks and weekly schedules,
+    from the same distributions as ArrayPandemicModel.create_agents but with a NumPy generator seeded with seed.
+    Other model parameters are accepted and ignored, so a model's keyword arguments can be passed straight in.
+    :return: dict of arrays that ArrayPandemicModel takes as its population
+    """
+    rng = np.random.default_rng(seed)
+    n_single = n - n_couples * 2
+    houses = np.array(house_cells(width, height, house_depth), dtype=np.int64).reshape(-1, 2)
+    # Singles draw a second house cell to start in, like PandemicModel.create_agents
+    if 2 * n_single + n_couples > len(houses):
+        raise ValueError("Too many people in the model")
+    unused = unused_cells(width, height, houses)
+    counts = [n_schools, n_workplaces, n_shops, n_churches]
+    order = rng.permutation(len(unused))
+    features = np.split(unused[order[:sum(counts)]], np.cumsum(counts)[:-1])
+    remaining_unused = np.sort(unused[order[sum(counts):]])
+
+    house_order = rng.permutation(len(houses))
+    flat_houses = houses[house_order, 0] * height + houses[house_order, 1]
+    single_house = flat_houses[:n_single]
+    single_position = flat_houses[n_single:2 * n_single]
+    couple_house = flat_houses[2 * n_single:2 * n_single + n_couples]
+
+    first_age = rng.integers(18, 66, n_couples)
+    couple_ages = np.stack([first_age + rng.integers(-5, 6, n_couples), first_age, rng.integers(0, 18, n_couples)],
+                           axis=1)
+    household_size = 2 + (np.arange(n_couples) < n_couples * couples_with_kids_percentage)
+    members = np.arange(3) < household_size[:, None]
+    couple_house = np.repeat(couple_house, household_size)
+    ages = np.concatenate([rng.integers(18, 66, n_single), couple_ages[members]]).astype(np.int32)
+    masked = np.concatenate([np.arange(n_single) < n_single * masked_percentage,
+                             np.repeat(np.arange(n_couples) < n_couples * masked_percentage, household_size)])
+
+    venues = np.concatenate(features)
+    venue_ids = np.split(np.arange(len(venues)), np.cumsum(counts)[:-1])
+    normal, lockdown = generate_weekly_schedules(rng, ages, *venue_ids)
+    table = ScheduleTable(height)
+    for cell in venues.tolist():
+        table.venue(divmod(cell, height))
+    population = {"ages": ages, "house": np.concatenate([single_house, couple_house]),
+                  "position": np.concatenate([single_position, couple_house]), "masked": masked,
+                  "normal_schedule": table.add_many(normal), "lockdown_schedule": table.add_many(lockdown),
+                  "schedule_table": table.table[:table.n_rows], "venues": np.array(table.venues).reshape(-1, 2),
+                  "empty_house_cells": houses[house_order[2 * n_single + n_couples:]],
+                  "unused_cells": np.stack(np.divmod(remaining_unused, height), axis=1)}
+    for name, cells in zip(FEATURES, features):
+        population[name] = np.stack(np.divmod(cells, height), axis=1)
+    return population
+
+
+def population_key(seed, params):
+    """
+    :return: hex digest identifying the population drawn for seed and the generation parameters in params
+    """
+    key = [POPULATION_VERSION, seed, {name: params[name] for name in GENERATION_PARAMETERS}]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def cached_population(cache_dir, seed, **params):
+    """
+    build_population, saved to cache_dir under population_key the first time and loaded from there afterwards, so
+    runs that only differ in epidemic parameters share their town.
+    :return: the population
+    """
+    path = os.path.join(cache_dir, population_key(seed, params) + ".npz")
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    population = build_population(seed, **params)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name first so a worker never loads a half-written file
+    partial = f"{path}.{os.getpid()}.npz"
+    np.savez(partial, **population)
+    os.replace(partial, path)
+    return population
@@ -0,0 +1,70 @@
+import numpy as np
+
+from counters import SUSCEPTIBLE, INFECTED, RECOVERED, QUARANTINED, DEAD
+
+# The hourly disease timers of the array engines, shared by ArrayPandemicModel and EnsembleModel. Each function takes
+# a model whose state is held in arrays of one shape with an entry per person: (people,) for a town or
+# (replicates, people) for an ensemble. Besides those arrays and the disease parameters, the model provides
+# add_counts(compartment, people, amount) and move_counts(source, destination, people), people being a mask over
+# the arrays, to keep its compartment counters in step.
+
+
+def symptomatic(model, hours_ahead=0):
+    """
+    :return: mask of the people who may go into quarantine once their infection timer has advanced hours_ahead
+    """
+    return model.infected & ~model.quarantined & ~model.asymptomatic & (
+            model.time_infected + hours_ahead >= model.time_till_symptoms * 24)
+
+
+def progress_infections(model, rng, quarantines=None):
+    """
+    Advance the infection timers, recover people who have served their infection length and send symptomatic
+    people into quarantine with the same hourly chance as Person.show_symptoms. quarantines, when given, is the
+    mask of who goes into quarantine instead of drawing it.
+    :return:
+    """
+    model.time_infected[model.infected] += 1
+    recovered = model.infected & (model.time_infected == model.infection_length * 24)
+    model.infected[recovered] = False
+    model.immune[recovered] = True
+    model.time_recovered[recovered] = 0
+    model.time_infected[recovered] = 0
+    model.move_counts(INFECTED, RECOVERED, recovered)
+
+    if quarantines is None:
+        quarantines = symptomatic(model)
+        quarantines[quarantines] = rng.random(np.count_nonzero(quarantines)) < 0.5
+    model.quarantined[quarantines] = True
+    model.add_counts(QUARANTINED, quarantines)
+
+
+def progress_immunity(model):
+    model.time_recovered[model.immune] += 1
+    lost = model.immune & (model.time_recovered == model.immunity_length * 24)
+    model.immune[lost] = False
+    model.time_recovered[lost] = 0
+    model.move_counts(RECOVERED, SUSCEPTIBLE, lost)
+
+
+def progress_quarantine(model):
+    # Like Person.quarantine_toggle, time_quarantined is never reset, so only the first quarantine ever ends
+    model.time_quarantined[model.quarantined] += 1
+    released = model.quarantined & (model.time_quarantined == model.quarantine_length * 24)
+    model.quarantined[released] = False
+    model.add_counts(QUARANTINED, released, -1)
+
+
+def attempt_deaths(model, rng):
+    """
+    Kill each person whose death attempt day has come with their death probability.
+    :return: mask of the people who died
+    """
+    due = model.infected & (model.time_infected == model.death_attempt_day * 24)
+    due[due] = rng.random(np.count_nonzero(due)) < model.death_probability[due]
+    model.alive[due] = False
+    model.infected[due] = False
+    model.move_counts(INFECTED, DEAD, due)
+    model.add_counts(QUARANTINED, due & model.quarantined, -1)
+    model.quarantined[due] = False
+    return due
@@ -0,0 +1,222 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from array_model import ArrayPandemicModel
+from sweep import REPORTERS, job_seed
+from transmission import infection_chance
+
+WEEK = 7 * 24
+# Visitors' state when they cross over; quarantined people stay at home
+VISITOR_SUSCEPTIBLE, VISITOR_INFECTED, VISITOR_IMMUNE = range(3)
+
+
+class TownModel(ArrayPandemicModel):
+    """
+    One town of a region, run as a shard in its own process.
+
+    A share of the adults commute to a workplace in another town. While their schedule has them at work they are
+    taken out of their own town and simulated as visitors at that workplace; everything else about them (timers,
+    quarantine, death) stays with their own town. A visitor's state is fixed when they cross over, except for being
+    infected at the workplace, which is reported back when they return.
+    """
+
+    def __init__(self, town, workplaces, commuter_fraction, seed=None, **params):
+        super().__init__(seed=seed, **params)
+        self.town = town
+        adults = np.flatnonzero(self.ages > 17)
+        self.commuters = adults[self.rng.random(len(adults)) < commuter_fraction] if len(workplaces) > 1 else adults[:0]
+        destination = self.rng.integers(0, max(len(workplaces) - 1, 1), len(self.commuters))
+        self.destination = destination + (destination >= town)
+        self.destination_workplace = self.rng.integers(0, np.array(workplaces)[self.destination])
+        # Adults are always at their workplace at 9 on the first day of their normal week
+        self.work_venue = self.schedule_table.table[self.normal_schedule[self.commuters], 0, 9]
+        self.away_until = np.zeros(len(self.commuters), dtype=np.int64)
+        self.away = np.zeros(self.n_agents, dtype=bool)
+
+        self.visitor_town = np.zeros(0, dtype=np.int64)
+        self.visitor_id = np.zeros(0, dtype=np.int64)
+        self.visitor_cell = np.zeros(0, dtype=np.int64)
+        self.visitor_state = np.zeros(0, dtype=np.int8)
+        self.visitor_modifier = np.zeros(0)
+        self.visitor_arrived = np.zeros(0, dtype=np.int64)
+        self.visitor_until = np.zeros(0, dtype=np.int64)
+        self.visitor_infected_at = np.zeros(0, dtype=np.int64)
+
+    def at_work(self, lockdown):
+        """
+        :return: (commuters, hours of the week) mask of when each commuter's normal or lockdown week has them at work
+        """
+        rows = (self.lockdown_schedule if lockdown else self.normal_schedule)[self.commuters]
+        return self.schedule_table.table[rows].reshape(len(rows), WEEK) == self.work_venue[:, None]
+
+    def boundary_slots(self):
+        """
+        :return: (hours of the week,) mask of the hours in which some commuter may leave for work or come back
+        """
+        slots = np.zeros(WEEK, dtype=bool)
+        for lockdown in [False, True]:
+            at_work = self.at_work(lockdown)
+            slots |= (at_work != np.roll(at_work, 1, axis=1)).any(axis=0)
+        return slots
+
+    def transmit(self, day, hour, infections=None):
+        """
+        ArrayPandemicModel.transmit with commuters who are away left out and visitors added at their workplace.
+        A visitor's previous location is their workplace after their first hour here and otherwise an extra key
+        that matches no cell of this town. Infections drawn in advance and contact logs are not supported, since
+        neither covers the visitors.
+        :return:
+        """
+        if infections is not None:
+            raise ValueError("TownModel draws its own infections")
+        if self.contact_log is not None:
+            raise RuntimeError("TownModel does not record contacts; detach the contact log before stepping")
+        sources = np.flatnonzero(self.infected & ~self.away)
+        targets = np.flatnonzero(self.alive & ~self.infected & ~self.immune & ~self.away)
+        visiting_sources = np.flatnonzero(self.visitor_state == VISITOR_INFECTED)
+        visiting_targets = np.flatnonzero(self.visitor_state == VISITOR_SUSCEPTIBLE)
+        if len(sources) + len(visiting_sources) == 0 or len(targets) + len(visiting_targets) == 0:
+            return
+        previous_hour = (hour - 1) % 24
+        visitor_keys = np.where(self.visitor_arrived < self.hours, self.visitor_cell, self.n_cells)
+        probability = infection_chance(
+            np.concatenate([self.position[sources], self.visitor_cell[visiting_sources]]),
+            np.concatenate([self.active_location(sources, day, previous_hour), visitor_keys[visiting_sources]]),
+            np.concatenate([self.infection_modifier[sources], self.visitor_modifier[visiting_sources]]),
+            np.concatenate([self.position[targets], self.visitor_cell[visiting_targets]]),
+            np.concatenate([self.active_location(targets, self.ages[targets] % 7, previous_hour),
+                            visitor_keys[visiting_targets]]),
+            np.concatenate([self.infection_modifier[targets], self.visitor_modifier[visiting_targets]]),
+            self.infection_probability, self.n_cells + 1)
+        infected = self.rng.random(len(probability)) < probability
+        self.infect(targets[infected[:len(targets)]])
+        infected_visitors = visiting_targets[infected[len(targets):]]
+        self.visitor_state[infected_visitors] = VISITOR_INFECTED
+        self.visitor_infected_at[infected_visitors] = self.hours
+
+    def fast_forward(self, hours):
+        raise RuntimeError("TownModel cannot be fast forwarded, as the skipped hours would leave out the visitors")
+
+    def crossings(self):
+        """
+        Called between steps at a boundary hour. Visitors whose stay is over leave with their outcome and commuters
+        now scheduled at work leave for their destination, staying as long as their current week keeps them there.
+        :return: departures and outcomes, each a dict keyed by the town they go to
+        """
+        leaving = self.visitor_until == self.hours
+        outcomes = {}
+        for town in np.unique(self.visitor_town[leaving]):
+            selected = leaving & (self.visitor_town == town)
+            outcomes[int(town)] = (self.visitor_id[selected], self.visitor_infected_at[selected])
+        for name in ["visitor_town", "visitor_id", "visitor_cell", "visitor_state", "visitor_modifier",
+                     "visitor_arrived", "visitor_until", "visitor_infected_at"]:
+            setattr(self, name, getattr(self, name)[~leaving])
+
+        self.away_until[self.away_until == self.hours] = 0
+        slot = (self.hours - 1) % WEEK
+        at_work = self.at_work(self.lockdown_active)
+        people = self.commuters
+        leaving = ((self.away_until == 0) & at_work[:, slot] & self.alive[people] & ~self.quarantined[people])
+        # Hours until the first one of the week, counting from this one, that is not at work
+        stay = np.argmin(np.roll(at_work[leaving], -slot, axis=1), axis=1)
+        self.away_until[leaving] = self.hours + stay
+        self.away[:] = False
+        self.away[people[self.away_until > 0]] = True
+
+        state = np.select([self.infected[people], self.immune[people]], [VISITOR_INFECTED, VISITOR_IMMUNE],
+                          VISITOR_SUSCEPTIBLE).astype(np.int8)
+        departures = {}
+        for town in np.unique(self.destination[leaving]):
+            selected = np.flatnonzero(leaving)[self.destination[leaving] == town]
+            departures[int(town)] = (people[selected], state[selected], self.infection_modifier[people[selected]],
+                                     self.destination_workplace[selected], self.away_until[selected])
+        return departures, outcomes
+
+    def receive(self, town, arrivals, outcomes):
+        """
+        Take in the visitors arriving from town and apply the infections that this town's returning commuters
+        picked up there, with their infection timers advanced to where they would be by now.
+        :return:
+        """
+        if arrivals is not None:
+            ids, state, modifier, workplace, until = arrivals
+            cells = np.array([self.cell_index(self.workplaces[idx]) for idx in workplace], dtype=np.int64)
+            self.visitor_town = np.concatenate([self.visitor_town, np.full(len(ids), town)])
+            self.visitor_id = np.concatenate([self.visitor_id, ids])
+            self.visitor_cell = np.concatenate([self.visitor_cell, cells])
+            self.visitor_state = np.concatenate([self.visitor_state, state])
+            self.visitor_modifier = np.concatenate([self.visitor_modifier, modifier])
+            self.visitor_arrived = np.concatenate([self.visitor_arrived, np.full(len(ids), self.hours)])
+            self.visitor_until = np.concatenate([self.visitor_until, until])
+            self.visitor_infected_at = np.concatenate([self.visitor_infected_at, np.full(len(ids), -1)])
+        if outcomes is not None:
+            ids, infected_at = outcomes
+            infected = (infected_at >= 0) & self.alive[ids] & ~self.infected[ids] & ~self.immune[ids]
+            self.infect(ids[infected])
+            self.time_infected[ids[infected]] = self.hours - infected_at[infected]
+
+
+def shard(conn, town, params, seed, workplaces, commuter_fraction):
+    model = TownModel(town, workplaces, commuter_fraction, seed=seed, **params)
+    conn.send(model.boundary_slots())
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        until, arrivals, outcomes = message
+        for source in set(arrivals) | set(outcomes):
+            model.receive(source, arrivals.get(source), outcomes.get(source))
+        while model.hours < until:
+            model.step()
+        conn.send(model.crossings())
+    conn.send(np.array([model.datacollector.model_vars[x] for x in REPORTERS], dtype=np.float64).T)
+    conn.close()
+
+
+def run_region(towns, num_steps, commuter_fraction=0.1, seed=0):
+    """
+    Simulate a region of towns, each given by its model keyword arguments, with one worker process per town.
+    The workers run on their own between boundary hours, when some commuter may leave for work or come back, and
+    only then send the people crossing over and the infections picked up by those returning.
+    :return: a reporter frame per town and one for the whole region
+    """
+    workplaces = [params["n_workplaces"] for params in towns]
+    connections, workers = [], []
+    for town, params in enumerate(towns):
+        conn, worker_conn = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=shard, args=(worker_conn, town, params, job_seed(seed, town, 0),
+                                                             workplaces, commuter_fraction))
+        worker.start()
+        connections.append(conn)
+        workers.append(worker)
+
+    slots = np.zeros(WEEK, dtype=bool)
+    for conn in connections:
+        slots |= conn.recv()
+    # A boundary hour of the week is acted on once its step is done
+    boundaries = np.flatnonzero(np.roll(slots, 1))
+    arrivals = [{} for _ in towns]
+    outcomes = [{} for _ in towns]
+    hours = 0
+    while hours < num_steps:
+        ahead = (boundaries - hours - 1) % WEEK + 1 if len(boundaries) else [num_steps]
+        hours = min(hours + int(np.min(ahead)), num_steps)
+        for town, conn in enumerate(connections):
+            conn.send((hours, arrivals[town], outcomes[town]))
+        arrivals = [{} for _ in towns]
+        outcomes = [{} for _ in towns]
+        for town, conn in enumerate(connections):
+            departures, returns = conn.recv()
+            for destination, crossing in departures.items():
+                arrivals[destination][town] = crossing
+            for home, outcome in returns.items():
+                outcomes[home][town] = outcome
+
+    frames = []
+    for conn, worker in zip(connections, workers):
+        conn.send(None)
+        frames.append(pd.DataFrame(conn.recv(), columns=REPORTERS))
+        worker.join()
+    return frames, sum(frames)
@@ -0,0 +1,90 @@
+import multiprocessing
+import random
+
+import numpy as np
+from tqdm import tqdm
+
+from checkpoint import PARAMETERS, PERSON_TYPES, checkpoint_state, restore_state
+from counters import DEAD
+from sweep import REPORTERS, RunningSeries, job_seed
+
+_base_state = None
+
+
+def fork(model, seed=None, **overrides):
+    """
+    Branch a scenario off a live model. The fork starts from the model's current state with its own random streams,
+    seeded with seed, and the given parameters overridden; the model itself is left as it was.
+    :return: the forked model
+    """
+    return fork_state(checkpoint_state(model), seed, overrides)
+
+
+def fork_state(state, seed, overrides):
+    unknown = set(overrides) - set(PARAMETERS)
+    if unknown:
+        raise ValueError(f"Cannot override {sorted(unknown)}, expected some of {PARAMETERS}")
+    rng = np.random.default_rng(seed)
+    if "masked_percentage" in overrides:
+        state = redeal_masks(state, overrides["masked_percentage"], rng)
+    model = restore_state(state)
+    model.random = random.Random(int(rng.integers(2 ** 63)))
+    if hasattr(model, "rng"):
+        model.rng = rng
+    for name, value in overrides.items():
+        setattr(model, name, value)
+    if "masked_percentage" in overrides:
+        model.counters.counts[:DEAD] = model.scan_compartments()
+    return model
+
+
+def redeal_masks(state, masked_percentage, rng):
+    """
+    masked_percentage only shapes the population when it is built, so for a live model the masks are dealt again:
+    that share of the living people, picked at random, wear one from the fork onwards.
+    :return: a copy of state with the new masks
+    """
+    state = dict(state)
+    alive = np.flatnonzero(state["alive"]) if "alive" in state else np.arange(len(state["masked"]))
+    masked = np.zeros_like(state["masked"])
+    masked[rng.permutation(alive)[:round(len(alive) * masked_percentage)]] = True
+    state["masked"] = masked
+    state["infection_modifier"] = np.where(masked, 0.5 * 0.4, 1.0)
+    if "type" in state:
+        # Infected and quarantined people keep their type until they go back to the default one
+        default = state["type"] <= PERSON_TYPES.index("Masked")
+        state["type"] = np.where(default, masked.astype(np.int8), state["type"])
+    return state
+
+
+def set_base_state(state):
+    global _base_state
+    _base_state = state
+
+
+def run_fork(job):
+    scenario, replicate, overrides, seed, num_steps = job
+    model = fork_state(_base_state, seed, overrides)
+    for _ in range(num_steps):
+        model.step()
+    series = np.array([model.datacollector.model_vars[x] for x in REPORTERS], dtype=np.float64).T
+    return scenario, replicate, series
+
+
+def fork_scenarios(model, scenarios, num_steps, replicates=1, processes=None, seed=0):
+    """
+    Fork every scenario (a dict of parameter overrides) off the model replicates times and run the forks for
+    num_steps on a process pool. The model is checkpointed once and handed to the workers when they start, so
+    with the fork start method they share its pages and nothing but the reporter series comes back.
+    :return: a frame per scenario with the mean of each reporter over the replicates and its 95% CI half width,
+    covering the model's history before the fork followed by the forked steps
+    """
+    state = checkpoint_state(model)
+    num_rows = len(model.datacollector.model_vars[REPORTERS[0]]) + num_steps
+    jobs = [(scenario, replicate, overrides, job_seed(seed, scenario, replicate), num_steps)
+            for scenario, overrides in enumerate(scenarios) for replicate in range(replicates)]
+    results = [RunningSeries(num_rows) for _ in scenarios]
+    with multiprocessing.Pool(processes, initializer=set_base_state, initargs=(state,)) as pool:
+        for scenario, replicate, series in tqdm(pool.imap_unordered(run_fork, jobs), total=len(jobs)):
+            results[scenario].add(series)
+    return [result.frame() for result in results]
@@ -0,0 +1,172 @@
+import numpy as np
+
+HOME = -1
+
+
+class ScheduleTable:
+    """
+    The weekly schedules of a whole population.
+
+    Every schedule is a 7x24 block of venue ids inside one int32 array. Identical schedules are stored once and
+    people only hold the row index of theirs. HOME stands for the person's own house, so schedules do not depend on
+    the household and the quarantine schedule is simply the all-HOME row. The index from a schedule's bytes to its
+    row, which only add needs, is built on first use when the table was rebuilt from arrays.
+    """
+
+    def __init__(self, height):
+        self.height = height
+        self.venues = []
+        self.venue_ids = {}
+        self._rows = {}
+        self.n_rows = 0
+        self.table = np.empty((16, 7, 24), dtype=np.int32)
+        self._venue_cells = None
+        self.home_row = self.add(np.full((7, 24), HOME, dtype=np.int32))
+
+    def venue(self, pos):
+        """
+        :return: the venue id of the cell at pos, registering it on first use
+        """
+        if pos not in self.venue_ids:
+            self.venue_ids[pos] = len(self.venues)
+            self.venues.append(pos)
+            self._venue_cells = None
+        return self.venue_ids[pos]
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = {row.tobytes(): idx for idx, row in enumerate(self.table[:self.n_rows])}
+        return self._rows
+
+    def add(self, schedule):
+        """
+        Store a 7x24 array of venue ids, reusing the row of an identical schedule if there is one.
+        :return: the schedule's row index
+        """
+        key = schedule.tobytes()
+        if key not in self.rows:
+            if self.n_rows == len(self.table):
+                self.table = np.concatenate([self.table, np.empty_like(self.table)])
+            self.table[self.n_rows] = schedule
+            self.rows[key] = self.n_rows
+            self.n_rows += 1
+        return self.rows[key]
+
+    def add_many(self, schedules):
+        """
+        Store an (n, 7, 24) array of schedules, each identical schedule once.
+        :return: row index of each schedule
+        """
+        return np.array([self.add(schedule) for schedule in schedules], dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, height, table, venues):
+        """
+        Rebuild a table from its stored rows and (n, 2) array of venue cells. The rows are not indexed until the
+        first add, so a table that is only read back costs no more than copying the arrays.
+        """
+        schedule_table = cls(height)
+        schedule_table.venues = [tuple(venue) for venue in venues.tolist()]
+        schedule_table.venue_ids = {venue: idx for idx, venue in enumerate(schedule_table.venues)}
+        schedule_table.table = np.array(table, dtype=np.int32)
+        schedule_table.n_rows = len(table)
+        schedule_table._rows = None
+        return schedule_table
+
+    def position(self, row, day, hour, house):
+        venue = self.table[row, day, hour]
+        return house if venue == HOME else self.venues[venue]
+
+    @property
+    def venue_cells(self):
+        """
+        Flat cell index (x * height + y) of every venue, followed by a HOME entry so that venue ids index it directly.
+        """
+        if self._venue_cells is None:
+            self._venue_cells = np.array([x * self.height + y for x, y in self.venues] + [HOME], dtype=np.int64)
+        return self._venue_cells
+
+    def cells(self, rows, day, hour, houses):
+        """
+        Vectorised position lookup for many people at once.
+        :return: flat cell index for each row, taking the matching entry of houses where the schedule says HOME
+        """
+        venues = self.table[rows, day, hour]
+        return np.where(venues == HOME, houses, self.venue_cells[venues])
+
+
+def generate_daily_schedule(model, age, spouse_schedules=None):
+    """
+    Draw a person's normal and lockdown week from the model's venues and store both in its schedule table.
+    :return: normal and lockdown row indices
+    """
+    table = model.schedule_table
+    schedule = np.full((7, 24), HOME, dtype=np.int32)
+    lockdown_schedule = np.full((7, 24), HOME, dtype=np.int32)
+    if age > 17:
+        work_place = table.venue(model.random.choice(model.workplaces))
+    else:
+        work_place = table.venue(model.random.choice(model.schools))
+    shop = table.venue(model.random.choice(model.shops))
+    for j in range(0, 4):
+        for i in range(9, 17):
+            schedule[j, i] = work_place
+            if age > 17:
+                if model.random.random() < 0.2:
+                    lockdown_schedule[j, i] = work_place
+        if model.random.random() < 0.4:
+            schedule[j, 18:20] = shop
+            if model.random.random() < 0.05:
+                lockdown_schedule[j, 18:20] = shop
+
+    if model.random.random() < 0.8:
+        shop_time = model.random.randint(10, 20)
+        schedule[5, shop_time:shop_time + 2] = shop
+
+        if model.random.random() < 0.05:
+            lockdown_schedule[5, shop_time:shop_time + 2] = shop
+
+    if spouse_schedules:
+        schedule[6, 10] = table.table[spouse_schedules[0], 6, 10]
+        lockdown_schedule[6, 10] = table.table[spouse_schedules[1], 6, 10]
+    else:
+        if model.random.random() < 0.5:
+            church_choice = table.venue(model.random.choice(model.churches))
+            schedule[6, 10] = church_choice
+            if model.random.random() < 0.05:
+                lockdown_schedule[6, 10] = church_choice
+
+    return table.add(schedule), table.add(lockdown_schedule)
+
+
+def generate_weekly_schedules(rng, ages, schools, workplaces, shops, churches):
+    """
+    Draw the normal and lockdown weeks of many people at once, from the same distributions as
+    generate_daily_schedule. The venue arguments are arrays of venue ids to choose from.
+    :return: two (people, 7, 24) arrays of venue ids
+    """
+    n = len(ages)
+    adult = ages > 17
+    schedule = np.full((n, 7, 24), HOME, dtype=np.int32)
+    lockdown_schedule = np.full((n, 7, 24), HOME, dtype=np.int32)
+    work_place = np.where(adult, rng.choice(workplaces, n), rng.choice(schools, n))[:, None, None]
+    shop = rng.choice(shops, n)[:, None, None]
+
+    schedule[:, :4, 9:17] = work_place
+    lockdown_schedule[:, :4, 9:17] = np.where(adult[:, None, None] & (rng.random((n, 4, 8)) < 0.2), work_place, HOME)
+    evening = rng.random((n, 4, 1)) < 0.4
+    schedule[:, :4, 18:20] = np.where(evening, shop, HOME)
+    lockdown_schedule[:, :4, 18:20] = np.where(evening & (rng.random((n, 4, 1)) < 0.05), shop, HOME)
+
+    saturday = rng.random((n, 1)) < 0.8
+    shop_time = rng.integers(10, 21, (n, 1))
+    shop_hours = (np.arange(24) >= shop_time) & (np.arange(24) < shop_time + 2)
+    schedule[:, 5] = np.where(saturday & shop_hours, shop[:, 0], HOME)
+    lockdown_schedule[:, 5] = np.where(saturday & shop_hours & (rng.random((n, 1)) < 0.05), shop[:, 0], HOME)
+
+    church = rng.random(n) < 0.5
+    church_choice = rng.choice(churches, n)
+    schedule[:, 6, 10] = np.where(church, church_choice, HOME)
+    lockdown_schedule[:, 6, 10] = np.where(church & (rng.random(n) < 0.05), church_choice, HOME)
+    return schedule, lockdown_schedule
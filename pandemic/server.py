@@ -1,8 +1,11 @@
-from mesa.visualization.modules import CanvasGrid
 from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.modules import ChartModule
+from delta_grid import DeltaGrid, batched
 from models import *
 
+# Model hours advanced between frames
+STEPS_PER_FRAME = 4
+
 
 def agent_portrayal(agent):
     portrayal = {"Shape": "circle",
@@ -22,8 +25,8 @@ def agent_portrayal(agent):
 if __name__ == "__main__":
     chart_score = ChartModule([{"Label": "Infected", "Color": "Green"}, {"Label": "Dead", "Color": "Black"}, {"Label": "Alive", "Color": "Red"}, {"Label" : "Uninfected", "Color" : "Orange"}], data_collector_name='datacollector')
     chart_inf_dead = ChartModule([{"Label": "Infected", "Color": "Green"}, {"Label": "Dead", "Color": "Black"}], data_collector_name='datacollector')
-    grid = CanvasGrid(agent_portrayal, 50, 50, 700, 700)
-    server = ModularServer(PandemicModel, [grid, chart_score, chart_inf_dead], "Pandemic Model",
+    grid = DeltaGrid(agent_portrayal, 50, 50, 700, 700, state_method=lambda agent: agent.type)
+    server = ModularServer(batched(PandemicModel, STEPS_PER_FRAME), [grid, chart_score, chart_inf_dead], "Pandemic Model",
                            {"n": 400, "width": 50, "height": 50, "masked_percentage" : 0.30 , "asymptomatic_probability":0.2, "infection_length" : 10  , "infection_probability" : 0.12  , "time_till_symptoms" : 5 , "quarantine_length" : 14 , "immunity_length" : 120 , "n_workplaces" : 25 , "n_shops" : 5 , "n_schools" : 2 , "n_churches" : 2, "n_couples" : 150, "couples_with_kids_percentage" : 0.7, "initial_infected_percentage" : 0.005, "house_depth":4, "lockdown_threshold" : 0.01, "liftlockdown_threshold" : 0.005})
     server.port = 8521
     server.launch()
@@ -0,0 +1,111 @@
+import numpy as np
+import pyarrow as pa
+
+CADENCES = ["hourly", "daily", "on-change"]
+
+
+class StreamingSink:
+    """
+    Drop-in replacement for a model's DataCollector that streams reporter rows to an append-only Arrow IPC file.
+
+    Rows are buffered in preallocated typed columns and written a chunk at a time, so memory stays flat however long
+    the run is. Each row holds the model hour and day next to the reporters. Cadence picks which hours are written:
+    every hour, the last hour of each day, or only hours where a reporter changed. Per-day peaks and the running
+    peak of every reporter are kept on the side without keeping the series.
+    """
+
+    def __init__(self, path, model_reporters, cadence="hourly", chunk_size=4096):
+        if cadence not in CADENCES:
+            raise ValueError(f"Unknown cadence {cadence}, expected one of {CADENCES}")
+        self.path = path
+        self.model_reporters = model_reporters
+        self.cadence = cadence
+        self.chunk_size = chunk_size
+        self.columns = None
+        self.rows = 0
+        self.writer = None
+        self.last_values = None
+        self.day = None
+        self.day_peaks = None
+        self.daily_peaks = {name: [] for name in model_reporters}
+        self.peaks = {}
+
+    def collect(self, model):
+        values = {name: reporter() if callable(reporter) else getattr(model, reporter)
+                  for name, reporter in self.model_reporters.items()}
+        # Collected at the end of an hour, after the model's clock has moved on
+        hour = model.hours - 1
+        self.track_peaks(hour // 24, values)
+        if self.cadence == "daily" and model.time != 0:
+            return
+        if self.cadence == "on-change" and values == self.last_values:
+            return
+        self.last_values = values
+        self.append(hour, hour // 24, values)
+
+    def track_peaks(self, day, values):
+        if day != self.day:
+            self.end_day()
+            self.day = day
+            self.day_peaks = dict(values)
+        for name, value in values.items():
+            self.day_peaks[name] = max(self.day_peaks[name], value)
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def end_day(self):
+        if self.day_peaks is not None:
+            for name, value in self.day_peaks.items():
+                self.daily_peaks[name].append(value)
+
+    def append(self, hour, day, values):
+        if self.columns is None:
+            self.columns = {"Hour": np.empty(self.chunk_size, dtype=np.int64),
+                            "Day": np.empty(self.chunk_size, dtype=np.int64)}
+            for name, value in values.items():
+                dtype = np.int64 if isinstance(value, (int, np.integer)) else np.float64
+                self.columns[name] = np.empty(self.chunk_size, dtype=dtype)
+        self.columns["Hour"][self.rows] = hour
+        self.columns["Day"][self.rows] = day
+        for name, value in values.items():
+            self.columns[name][self.rows] = value
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.record_batch([pa.array(column[:self.rows]) for column in self.columns.values()],
+                                names=list(self.columns))
+        if self.writer is None:
+            self.writer = pa.ipc.new_stream(self.path, batch.schema)
+        self.writer.write_batch(batch)
+        self.rows = 0
+
+    def close(self):
+        """
+        Write out the last partial chunk and close the file. The day in progress is counted in daily_peaks.
+        """
+        self.flush()
+        self.end_day()
+        self.day_peaks = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def stream_reporters(model, path, cadence="hourly", chunk_size=4096):
+    """
+    Swap a model's DataCollector for a StreamingSink writing the same reporters to path.
+    :return: the sink, which should be closed once the run is over
+    """
+    model.datacollector = StreamingSink(path, model.datacollector.model_reporters, cadence, chunk_size)
+    return model.datacollector
+
+
+def read_sink(path):
+    """
+    :return: the rows streamed to path as a pandas DataFrame
+    """
+    with pa.ipc.open_stream(path) as reader:
+        return reader.read_all().to_pandas()
@@ -0,0 +1,152 @@
+import itertools
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from models import PandemicModel
+from population import cached_population
+
+REPORTERS = ["Dead", "Infected", "Total_Cases"]
+
+
+def grid_points(base_params, **axes):
+    """
+    Every combination of the values given for each swept parameter, applied on top of base_params.
+    :return: list of model keyword arguments, one dict per parameter point
+    """
+    names = list(axes)
+    return [dict(base_params, **dict(zip(names, values))) for values in itertools.product(*axes.values())]
+
+
+def job_seed(seed, point, replicate):
+    """
+    Seed of one (parameter point, replicate) job. It only depends on the sweep seed and the job's position, so a
+    sweep gives the same runs however many processes it is spread over.
+    """
+    return int(np.random.SeedSequence(seed, spawn_key=(point, replicate)).generate_state(1)[0])
+
+
+def run_job(job):
+    point, replicate, model_class, params, seed, num_steps, population_cache = job
+    if population_cache is not None:
+        params = dict(params, population=cached_population(population_cache, seed, **params))
+    model = model_class(seed=seed, **params)
+    for _ in range(num_steps):
+        model.step()
+    series = np.array([model.datacollector.model_vars[x] for x in REPORTERS], dtype=np.float64).T
+    return point, replicate, series
+
+
+class RunningSeries:
+    """
+    Running mean and variance (Welford) of replicate time series, so replicates are folded in as they arrive
+    instead of being kept.
+    """
+
+    def __init__(self, num_steps):
+        self.count = 0
+        self.mean = np.zeros((num_steps, len(REPORTERS)))
+        self.m2 = np.zeros((num_steps, len(REPORTERS)))
+
+    def add(self, series):
+        self.count += 1
+        delta = series - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (series - self.mean)
+
+    def ci(self, z=1.96):
+        """
+        :return: half width of the normal confidence interval of the mean, zero until there are two replicates
+        """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return z * np.sqrt(self.m2 / (self.count - 1) / self.count)
+
+    def frame(self):
+        frame = pd.DataFrame(self.mean, columns=REPORTERS)
+        ci = self.ci()
+        for idx, x in enumerate(REPORTERS):
+            frame[f"{x}_ci"] = ci[:, idx]
+        return frame
+
+
+def sweep(points, replicates, num_steps, processes=None, seed=0, model_class=PandemicModel, population_cache=None,
+          common_random_numbers=False, target_width=None, max_replicates=100, max_in_flight=None):
+    """
+    Run every parameter point replicates times on a process pool, one job per (point, replicate) with its own seed.
+    With a population_cache directory, which needs a model_class taking a population such as ArrayPandemicModel,
+    each job's town is built by cached_population and reused by later sweeps with the same seed.
+
+    With common_random_numbers, replicate r of every point gets the same seed, so points are compared on the same
+    towns, schedules and initial infections and their differences have far less noise than the points themselves.
+    With a target_width, replicates is the minimum: a point keeps getting replicates, up to max_replicates, until
+    the 95% CI of its final Dead and Total_Cases is narrower than target_width. Replicates are folded in in order,
+    so the stopping point does not depend on the order the jobs finish in. Past the minimum, a point has at most
+    max_in_flight jobs running at once, by default the pool's processes shared out between the points. Jobs still
+    running when their point stops cannot be cancelled; they run to the end and their results are discarded.
+    :return: a frame per point with the mean of each reporter over the replicates and its 95% CI half width, with
+    the number of replicates used in frame.attrs["replicates"], the number of simulations run for the point in
+    frame.attrs["simulations"] and how many of those were discarded in frame.attrs["discarded"]
+    """
+    if target_width is None:
+        max_replicates = replicates
+    if max_in_flight is None:
+        max_in_flight = max(1, (processes or os.cpu_count()) // len(points))
+    results = [RunningSeries(num_steps) for _ in points]
+    finished = [False] * len(points)
+    submitted = [0] * len(points)
+    completed = [0] * len(points)
+    pending = [{} for _ in points]
+    outcomes = queue.Queue()
+
+    def submit(point):
+        replicate = submitted[point]
+        submitted[point] += 1
+        job = (point, replicate, model_class, points[point],
+               job_seed(seed, 0 if common_random_numbers else point, replicate), num_steps, population_cache)
+        pool.apply_async(run_job, (job,), callback=outcomes.put, error_callback=outcomes.put)
+
+    with multiprocessing.Pool(processes) as pool, tqdm() as progress:
+        for point in range(len(points)):
+            for _ in range(replicates):
+                submit(point)
+        while sum(submitted) > progress.n:
+            outcome = outcomes.get()
+            progress.update()
+            if isinstance(outcome, BaseException):
+                raise outcome
+            point, replicate, series = outcome
+            completed[point] += 1
+            if finished[point]:
+                continue
+            pending[point][replicate] = series
+            while not finished[point] and results[point].count in pending[point]:
+                results[point].add(pending[point].pop(results[point].count))
+                finished[point] = results[point].count >= max_replicates or (
+                        results[point].count >= replicates and converged(results[point], target_width))
+            while (not finished[point] and submitted[point] < max_replicates
+                   and submitted[point] - completed[point] < max_in_flight):
+                submit(point)
+
+    frames = []
+    for result, simulations in zip(results, completed):
+        frame = result.frame()
+        frame.attrs["replicates"] = result.count
+        frame.attrs["simulations"] = simulations
+        frame.attrs["discarded"] = simulations - result.count
+        frames.append(frame)
+    return frames
+
+
+def converged(result, target_width):
+    """
+    :return: whether the 95% CIs of the final Dead and Total_Cases are both narrower than target_width
+    """
+    if target_width is None or result.count < 2:
+        return False
+    final = 2 * result.ci()[-1]
+    return bool(final[REPORTERS.index("Dead")] < target_width and final[REPORTERS.index("Total_Cases")] < target_width)
@@ -0,0 +1,19 @@
+from benchmark import BASE_PARAMS, house_count, scaled_params
+from population import house_cells
+
+
+def test_base_size_is_the_base_town():
+    assert scaled_params(BASE_PARAMS["n"]) == BASE_PARAMS
+
+
+def test_scaled_towns_have_room_for_every_household():
+    for n in [400, 2000, 10000, 100000]:
+        params = scaled_params(n)
+        households = 2 * (n - 2 * params["n_couples"]) + params["n_couples"]
+        assert house_count(params["width"], params["house_depth"]) >= households
+
+
+def test_house_count_matches_house_cells():
+    for width in range(10, 40):
+        for depth in range(1, width // 2):
+            assert house_count(width, depth) == len(house_cells(width, width, depth))
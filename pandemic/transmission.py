@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def infection_chance(source_cells, source_keys, source_modifiers, target_cells, target_keys, target_modifiers,
+                     infection_probability, n_keys):
+    """
+    Chance that each target is infected by at least one source in its cell, where every source whose key differs
+    from the target's key makes one independent attempt with probability
+    infection_probability * source_modifier * target_modifier.
+    Sources are grouped by cell once, so the cost is linear in the number of people rather than in cellmate pairs.
+    :return: probability per target
+    """
+    log_survival = np.zeros(len(target_cells))
+    pair_cells = source_cells * n_keys + source_keys
+    target_pair_cells = target_cells * n_keys + target_keys
+    for modifier in np.unique(target_modifiers):
+        selected = target_modifiers == modifier
+        weights = np.log1p(-np.minimum(infection_probability * source_modifiers * modifier, 1 - 1e-12))
+        log_survival[selected] = (group_sum(source_cells, weights, target_cells[selected])
+                                  - group_sum(pair_cells, weights, target_pair_cells[selected]))
+    return -np.expm1(log_survival)
+
+
+def group_sum(keys, weights, lookup):
+    """
+    Sum weights by key and read the sums back for each key in lookup, zero where a key has no weights.
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=weights, minlength=len(unique))
+    slot = np.minimum(np.searchsorted(unique, lookup), len(unique) - 1)
+    return np.where(unique[slot] == lookup, sums[slot], 0.0)
+
+
+def attribute_sources(rng, source_cells, source_keys, source_modifiers, target_cells, target_keys, target_modifiers,
+                      infection_probability):
+    """
+    Pick who infected each of the given (at least one) infected targets. Given that a target was infected, each source in its
+    cell was the one with a chance proportional to its hazard -log(1 - p) on that target, zero for sources whose key
+    matches the target's.
+    :return: index into the sources for each target
+    """
+    order = np.argsort(source_cells, kind="stable")
+    start = np.searchsorted(source_cells[order], target_cells, "left")
+    counts = np.searchsorted(source_cells[order], target_cells, "right") - start
+    ends = np.cumsum(counts)
+    pair_target = np.repeat(np.arange(len(target_cells)), counts)
+    pair_source = order[np.repeat(start, counts) + np.arange(ends[-1]) - np.repeat(ends - counts, counts)]
+    hazard = -np.log1p(-np.minimum(infection_probability * source_modifiers[pair_source] * target_modifiers[pair_target],
+                                   1 - 1e-12))
+    hazard[source_keys[pair_source] == target_keys[pair_target]] = 0
+    cumulative = np.cumsum(hazard)
+    before = np.concatenate([[0.0], cumulative])[ends - counts]
+    draw = before + rng.random(len(target_cells)) * (cumulative[ends - 1] - before)
+    return pair_source[np.minimum(np.searchsorted(cumulative, draw, side="right"), ends - 1)]